@@ -0,0 +1,189 @@
+'''Times the scan, validate, compare and promote phases of promote_tool against a
+synthetic tree (see synthetic_tree.py) and saves the results as JSON, e.g.
+
+    python benchmarks/run_benchmarks.py --services 50 --files 40 --output before.json
+    python benchmarks/run_benchmarks.py --services 50 --files 40 --compare before.json
+
+Each phase is timed over every from/to directory pair in the tree, repeated --repeat
+times, and the fastest and median runs are reported.
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tfpromote import promote_tool  # noqa: E402
+import synthetic_tree  # noqa: E402
+
+PHASES = ['scan', 'validate', 'compare', 'promote']
+
+
+def directory_pairs(env_dirs, regions):
+    '''Pairs each of the lowest environment's directories with the same (regional)
+    directory in the next environment up.'''
+    group = regions + 1
+    return list(zip(env_dirs[0:group], env_dirs[group:2 * group]))
+
+
+def scan(pairs):
+    files = []
+    for from_path, to_path in pairs:
+        files.append((
+            promote_tool.get_nonenv_tf_files_in_directory(from_path),
+            promote_tool.get_nonenv_tf_files_in_directory(to_path),
+            promote_tool.get_env_tf_files_in_directory(from_path),
+            promote_tool.get_env_tf_files_in_directory(to_path)))
+    return files
+
+
+def validate(files):
+    for from_nonenv, to_nonenv, from_env, to_env in files:
+        promote_tool.validate_filenames(from_nonenv, to_nonenv)
+        promote_tool.validate_filenames(from_env, to_env)
+
+
+def compare(pairs, files, jobs):
+    modified = []
+    for (from_path, to_path), (from_nonenv, to_nonenv, _, _) in zip(pairs, files):
+        common = [f for f in from_nonenv if f in set(to_nonenv)]
+        diffs = promote_tool.compare_filecontents(
+            common, from_path, to_path, use_env_prefix=False, ignore_missing=False,
+            jobs=jobs)
+        modified.append([filename for filename, _ in diffs])
+    return modified
+
+
+def promote(pairs, modified, scratch):
+    for idx, ((from_path, _), filenames) in enumerate(zip(pairs, modified)):
+        if filenames:
+            promote_tool.promote_files(filenames, from_path, os.path.join(scratch, str(idx)))
+
+
+def copy_targets(pairs, scratch):
+    '''Fresh copies of the target directories, so every promote run does the same work.'''
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    for idx, (_, to_path) in enumerate(pairs):
+        shutil.copytree(to_path, os.path.join(scratch, str(idx)))
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+
+def run(pairs, repeat, jobs, workdir):
+    timings = dict((phase, []) for phase in PHASES)
+    scratch = os.path.join(workdir, 'promote-scratch')
+    for _ in range(repeat):
+        elapsed, files = timed(scan, pairs)
+        timings['scan'].append(elapsed)
+        elapsed, _ = timed(validate, files)
+        timings['validate'].append(elapsed)
+        elapsed, modified = timed(compare, pairs, files, jobs)
+        timings['compare'].append(elapsed)
+        copy_targets(pairs, scratch)
+        # promote_files prints every file it promotes
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, _ = timed(promote, pairs, modified, scratch)
+        timings['promote'].append(elapsed)
+    return timings, sum(len(filenames) for filenames in modified)
+
+
+def summarize(times):
+    ordered = sorted(times)
+    return {
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2],
+        'runs': times
+    }
+
+
+def print_results(results, baseline=None):
+    for phase in PHASES:
+        line = "{:<10} min {:9.4f}s   median {:9.4f}s".format(
+            phase, results[phase]['min'], results[phase]['median'])
+        if baseline and phase in baseline and baseline[phase]['median']:
+            line += "   {:6.2f}x baseline median".format(
+                results[phase]['median'] / baseline[phase]['median'])
+        print(line)
+
+
+def get_version():
+    about = {}
+    version_path = os.path.join(
+        os.path.dirname(os.path.abspath(promote_tool.__file__)), 'version.py')
+    with open(version_path, 'r') as f:
+        exec(f.read(), about)
+    return about['__version__']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark tfpromote against a synthetic terraform tree.')
+    synthetic_tree.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=1, help='Passed to compare_filecontents')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', dest='baseline_path',
+        help='JSON results from an earlier run to compare against')
+    parser.add_argument('--workdir', help='Directory to generate the tree in, defaults to a temp dir')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    params = synthetic_tree.tree_params(args)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='tfpromote-bench-')
+    try:
+        root = os.path.join(workdir, 'tree')
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        started = time.perf_counter()
+        all_env_dirs = synthetic_tree.generate_tree(root, **params)
+        print("Generated {} services in {:.2f}s".format(
+            args.services, time.perf_counter() - started))
+        pairs = []
+        for env_dirs in all_env_dirs:
+            pairs.extend(directory_pairs(env_dirs, args.regions))
+
+        timings, modified_count = run(pairs, args.repeat, args.jobs, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = dict((phase, summarize(timings[phase])) for phase in PHASES)
+    baseline = None
+    if args.baseline_path:
+        with open(args.baseline_path, 'r') as f:
+            baseline = json.load(f)['results']
+    print("{} directory pairs, {} modified files per run".format(len(pairs), modified_count))
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'tfpromote_version': get_version(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'params': params,
+                'repeat': args.repeat,
+                'jobs': args.jobs,
+                'directory_pairs': len(pairs),
+                'modified_files': modified_count,
+                'results': results
+            }, f, indent=2, sort_keys=True)
+        print("Results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''Generates a synthetic monorepo of terraform environment directories for benchmarking:
+
+    root/svc-000/terraform/dev/dev-vars-000.tf
+    root/svc-000/terraform/dev/file-000.tf
+    root/svc-000/terraform/stage/...
+    root/svc-000/terraform/stage-us-east-1/...
+
+Every environment gets the same non-env files, then a fraction of the files in the
+lowest environment are changed so there is something to promote.  The same seed always
+generates the same tree.
+'''
+
+import os
+import sys
+import random
+import argparse
+
+ENVS = ['dev', 'stage', 'prod']
+
+
+def resource_block(rng, index):
+    return (
+        'resource "aws_iam_role" "role_{0}" {{\n'
+        '  name               = "role-{0}-{1}"\n'
+        '  assume_role_policy = "${{data.aws_iam_policy_document.doc_{0}.json}}"\n'
+        '  tags = {{\n'
+        '    Service = "svc"\n'
+        '    Index   = "{0}"\n'
+        '  }}\n'
+        '}}\n\n').format(index, rng.randint(0, 1000000))
+
+
+def file_contents(rng, size):
+    blocks = []
+    length = 0
+    while length < size:
+        block = resource_block(rng, len(blocks))
+        blocks.append(block)
+        length += len(block)
+    return ''.join(blocks)
+
+
+def change_contents(rng, contents):
+    '''Changes one attribute somewhere in the file, like a typical promotion.'''
+    lines = contents.split('\n')
+    candidates = [i for i, line in enumerate(lines) if line.strip().startswith('name ')]
+    idx = rng.choice(candidates)
+    lines[idx] = '  name               = "changed-{}"'.format(rng.randint(0, 1000000))
+    return '\n'.join(lines)
+
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def generate_tree(root, services=10, files=20, file_size=4096, change_ratio=0.1,
+                  env_files=2, regions=0, seed=0):
+    '''Writes the tree under root and returns the list of environment directories
+    created for each service, lowest environment first.'''
+    rng = random.Random(seed)
+    region_names = ['us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1',
+                    'ap-southeast-1', 'ap-northeast-1'][:regions]
+    all_env_dirs = []
+    for service_idx in range(services):
+        base = os.path.join(root, 'svc-{:03d}'.format(service_idx), 'terraform')
+        contents = [file_contents(rng, file_size) for _ in range(files)]
+        env_contents = [file_contents(rng, 256) for _ in range(env_files)]
+        env_dirs = []
+        for env in ENVS:
+            env_dirs.append((env, os.path.join(base, env)))
+            for region in region_names:
+                env_dirs.append((env, os.path.join(base, '{}-{}'.format(env, region))))
+        for env, env_dir in env_dirs:
+            os.makedirs(env_dir)
+            for file_idx, file_content in enumerate(contents):
+                write_file(os.path.join(env_dir, 'file-{:03d}.tf'.format(file_idx)), file_content)
+            for file_idx, file_content in enumerate(env_contents):
+                write_file(os.path.join(env_dir, '{}-vars-{:03d}.tf'.format(env, file_idx)),
+                           file_content.replace('svc', env))
+        # something to promote out of the lowest environment
+        for env, env_dir in env_dirs:
+            if env != ENVS[0]:
+                continue
+            for file_idx, file_content in enumerate(contents):
+                if rng.random() < change_ratio:
+                    write_file(os.path.join(env_dir, 'file-{:03d}.tf'.format(file_idx)),
+                               change_contents(rng, file_content))
+        all_env_dirs.append([env_dir for _, env_dir in env_dirs])
+    return all_env_dirs
+
+
+def add_arguments(parser):
+    parser.add_argument('--services', type=int, default=10)
+    parser.add_argument('--files', type=int, default=20, help='Non-env .tf files per environment')
+    parser.add_argument('--file-size', type=int, default=4096, help='Approximate bytes per file')
+    parser.add_argument('--change-ratio', type=float, default=0.1,
+        help='Fraction of files changed in the lowest environment')
+    parser.add_argument('--env-files', type=int, default=2, help='Env prefixed files per environment')
+    parser.add_argument('--regions', type=int, default=0, help='Regional directories per environment')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def tree_params(args):
+    return {
+        'services': args.services,
+        'files': args.files,
+        'file_size': args.file_size,
+        'change_ratio': args.change_ratio,
+        'env_files': args.env_files,
+        'regions': args.regions,
+        'seed': args.seed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic terraform tree.')
+    parser.add_argument('root')
+    add_arguments(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.root):
+        print("{} already exists".format(args.root))
+        sys.exit(1)
+    generate_tree(args.root, **tree_params(args))
+    print("Generated {} services under {}".format(args.services, args.root))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,2 @@
-from .tfpromote import main
+from .client import main
 main()
@@ -0,0 +1,214 @@
+import os
+import time
+import zlib
+import hashlib
+import logging
+import tarfile
+import zipfile
+import threading
+import collections
+from .snapshot import FileFilter, split_env_files, make_temp_directory
+from . import timings
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ['.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar', '.zip']
+READ_CHUNK_SIZE = 65536
+
+# what the rest of tfpromote uses of an os.stat_result
+MemberStat = collections.namedtuple('MemberStat', ['st_size', 'st_mtime'])
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_extension(path):
+    for extension in ARCHIVE_EXTENSIONS:
+        if path.lower().endswith(extension):
+            return extension
+    return None
+
+
+def is_archive(path):
+    return archive_extension(path) is not None and os.path.isfile(path)
+
+
+def archive_env_name(path):
+    '''The environment an archive holds, from its filename, e.g. dev.tar.gz or
+    dev-1.4.2.zip -> dev.'''
+    name = os.path.basename(path)
+    name = name[:len(name) - len(archive_extension(name) or '')]
+    return name.split('-')[0]
+
+
+def member_path(name):
+    '''A member's name as a relative path, or None for names that would be written
+    outside the directory it is extracted to.'''
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if name.startswith('/') or not parts or '..' in parts:
+        return None
+    return os.path.join(*parts)
+
+
+def top_level_directory(paths):
+    '''The directory every path is in, if the archive was made from a single directory
+    (e.g. tar -czf dev.tar.gz dev), otherwise None.'''
+    tops = set(path.split(os.sep, 1)[0] for path in paths)
+    if len(tops) != 1 or any(os.sep not in path for path in paths):
+        return None
+    return tops.pop()
+
+
+def strip_top_level(path, top):
+    if top is None:
+        return path
+    return path[len(top) + len(os.sep):]
+
+
+class ArchiveSnapshot(object):
+    '''The .tf files of a .tar.gz, .tgz, .tar.bz2, .tar.xz, .tar or .zip archive of an
+    environment directory, with the same interface and options as DirectorySnapshot.
+    The environment is named by the archive's filename, see archive_env_name.  If all
+    the files are in one directory that directory is treated as the environment
+    directory.
+
+    Nothing is extracted up front.  Tar archives are streamed once, keeping (and
+    hashing) only the members the filter includes, zip members are read from the
+    archive when they are first needed.  sha256 lets files be compared without being
+    written to disk, a member is only extracted to a temporary directory (see
+    make_temp_directory) when its path is asked for, to diff or promote it.'''
+
+    def __init__(self, archive_path, recursive=False, include=None, exclude=None):
+        self.archive_path = archive_path
+        self.env_name = archive_env_name(archive_path)
+        self.env_prefix = "{}-".format(self.env_name)
+        self.file_filter = FileFilter(recursive, include, exclude)
+        self.blob_ids = {}
+        # filename -> os.stat_result like MemberStat
+        self.stats = {}
+        # filename -> bytes, for tar archives which can't be read again without streaming
+        # through everything before the member
+        self.contents = {}
+        # filename -> name in a zip archive
+        self.zip_names = {}
+        self.digests = {}
+        self.extracted = set()
+        self.lock = threading.Lock()
+
+        self.directory = make_temp_directory('tfpromote-{}-'.format(
+            os.path.basename(archive_path).replace('.', '-')))
+
+        with timings.span('scan archive', 'file', archive=archive_path):
+            try:
+                if archive_extension(archive_path) == '.zip':
+                    self.read_zip()
+                else:
+                    self.read_tar()
+            except (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError, IOError) as e:
+                raise ArchiveError("Could not read {}: {}".format(archive_path, e))
+        self.nonenv_files, self.env_files = split_env_files(self.stats, self.env_prefix)
+        self.nonenv_set = set(self.nonenv_files)
+        self.env_set = set(self.env_files)
+        logger.info("Found {} non-env and {} env files in {}".format(
+            len(self.nonenv_files), len(self.env_files), archive_path))
+
+    def might_want(self, path):
+        '''Whether the filter wants path, with or without a top-level directory, before
+        it is known whether the archive has one.'''
+        if self.file_filter.wants(path):
+            return True
+        return os.sep in path and self.file_filter.wants(path.split(os.sep, 1)[1])
+
+    def read_tar(self):
+        paths = []
+        # path -> (contents, sha256, mtime)
+        candidates = {}
+        with tarfile.open(self.archive_path, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                path = member_path(member.name)
+                if path is None:
+                    logger.warning("Skipping {} in {}, it is outside the archive's directory".format(
+                        member.name, self.archive_path))
+                    continue
+                paths.append(path)
+                if not self.might_want(path):
+                    continue
+                sha = hashlib.sha256()
+                chunks = []
+                member_file = tar.extractfile(member)
+                while True:
+                    chunk = member_file.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    chunks.append(chunk)
+                candidates[path] = (b''.join(chunks), sha.hexdigest(), member.mtime)
+        top = top_level_directory(paths)
+        for path, (contents, digest, mtime) in candidates.items():
+            filename = strip_top_level(path, top)
+            if not self.file_filter.wants(filename):
+                continue
+            self.contents[filename] = contents
+            self.digests[filename] = digest
+            self.stats[filename] = MemberStat(len(contents), mtime)
+
+    def read_zip(self):
+        # only the zip's central directory is read here
+        infos = {}
+        with zipfile.ZipFile(self.archive_path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                path = member_path(info.filename)
+                if path is None:
+                    logger.warning("Skipping {} in {}, it is outside the archive's directory".format(
+                        info.filename, self.archive_path))
+                    continue
+                infos[path] = info
+        top = top_level_directory(infos)
+        for path, info in infos.items():
+            filename = strip_top_level(path, top)
+            if not self.file_filter.wants(filename):
+                continue
+            self.zip_names[filename] = info.filename
+            self.stats[filename] = MemberStat(
+                info.file_size, time.mktime(info.date_time + (0, 0, -1)))
+
+    def read(self, filename):
+        '''The member's contents, read from the archive.'''
+        if filename in self.contents:
+            return self.contents[filename]
+        with zipfile.ZipFile(self.archive_path) as archive:
+            return archive.read(self.zip_names[filename])
+
+    def has(self, filename):
+        return filename in self.stats
+
+    def stat(self, filename):
+        return self.stats[filename]
+
+    def sha256(self, filename):
+        with self.lock:
+            if filename not in self.digests:
+                with timings.span('hash file', 'file', file=filename):
+                    self.digests[filename] = hashlib.sha256(self.read(filename)).hexdigest()
+            return self.digests[filename]
+
+    def path(self, filename):
+        '''Where the member is extracted to, it is written there the first time.'''
+        path = os.path.join(self.directory, filename)
+        with self.lock:
+            if filename in self.stats and filename not in self.extracted:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(self.read(filename))
+                self.extracted.add(filename)
+        return path
+
+    def blob_id(self, filename):
+        return None
@@ -0,0 +1,167 @@
+'''The tfpromote/tfp entry point.  If a daemon (tfpromote --daemon) is listening the
+command is run there, with this process's stdin, stdout and stderr passed over the
+socket, otherwise it runs in this process as usual.  Only what's needed to talk to the
+daemon is imported here so that forwarding a command stays fast, which is also why
+the request is sent with marshal rather than json.'''
+
+import os
+import sys
+import stat
+import errno
+import array
+import socket
+import struct
+import marshal
+from .version import __version__
+
+# requests are sent as their length followed by the marshalled request
+REQUEST_LENGTH_SIZE = 8
+
+def get_socket_path():
+    '''TFPROMOTE_SOCKET if set, otherwise tfpromote.sock in XDG_RUNTIME_DIR or in a
+    tfpromote-<uid> directory of /tmp.  Whichever directory the socket is in must be
+    private to this user, see check_socket_directory.'''
+    socket_path = os.environ.get("TFPROMOTE_SOCKET")
+    if socket_path:
+        return socket_path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "tfpromote.sock")
+    return os.path.join("/tmp", "tfpromote-{}".format(os.getuid()), "tfpromote.sock")
+
+
+def check_socket_directory(socket_dir):
+    '''Returns why socket_dir can't be trusted to hold the daemon's socket, or None if
+    it is a directory (not a symlink) owned by this user which no one else can access.
+    Otherwise another user could put their own socket there and receive the
+    environment, including any credentials, and the terminal of every command.'''
+    try:
+        st = os.lstat(socket_dir)
+    except OSError as e:
+        return "{} can't be checked: {}".format(socket_dir, e)
+    if not stat.S_ISDIR(st.st_mode):
+        return "{} is not a directory".format(socket_dir)
+    if st.st_uid != os.getuid():
+        return "{} is owned by another user".format(socket_dir)
+    if st.st_mode & 0o077:
+        return "{} can be accessed by other users, its mode is {:o}".format(
+            socket_dir, stat.S_IMODE(st.st_mode))
+    return None
+
+
+def check_socket(socket_path):
+    '''check_socket_directory for the socket's directory, and the socket itself must be
+    a socket owned by this user.'''
+    problem = check_socket_directory(os.path.dirname(os.path.abspath(socket_path)))
+    if problem:
+        return problem
+    st = os.lstat(socket_path)
+    if not stat.S_ISSOCK(st.st_mode):
+        return "{} is not a socket".format(socket_path)
+    if st.st_uid != os.getuid():
+        return "{} is owned by another user".format(socket_path)
+    return None
+
+
+def get_peer_uid(conn):
+    '''The user id of the process listening on the other end of conn, where the
+    platform tells us (SO_PEERCRED on Linux), otherwise None.'''
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid
+
+
+def daemon_supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SCM_RIGHTS') and \
+        hasattr(socket.socket, 'sendmsg')
+
+
+def read_line(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(4096)
+        if not chunk:
+            return None
+        data += chunk
+    return data.decode('utf-8').rstrip('\n')
+
+
+def connect(socket_path):
+    '''Returns a socket connected to the daemon or None if it isn't running, or if the
+    socket or the process listening on it isn't this user's.'''
+    if not os.path.lexists(socket_path):
+        return None
+    problem = check_socket(socket_path)
+    if problem:
+        sys.stderr.write("Not using the tfpromote daemon socket {}: {}\n".format(
+            socket_path, problem))
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        peer_uid = get_peer_uid(conn)
+    except (IOError, OSError):
+        conn.close()
+        return None
+    if peer_uid is not None and peer_uid != os.getuid():
+        conn.close()
+        sys.stderr.write("Not using the tfpromote daemon socket {}: it is served by user {}\n".format(
+            socket_path, peer_uid))
+        return None
+    return conn
+
+
+def run_in_daemon(conn, argv):
+    '''Sends the command to the daemon and waits for it to finish.  Returns the exit
+    code, or None if the daemon declined it and it should be run locally instead.'''
+    request = marshal.dumps({
+        'version': __version__,
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ)
+    })
+    request = len(request).to_bytes(REQUEST_LENGTH_SIZE, 'big') + request
+    fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # the file descriptors go with the first part of the request
+    sent = conn.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                     array.array('i', fds))])
+    if sent < len(request):
+        try:
+            conn.sendall(request[sent:])
+        except (IOError, OSError) as e:
+            # the daemon may have already replied and closed the connection
+            if e.errno != errno.EPIPE:
+                raise
+    while True:
+        try:
+            reply = read_line(conn)
+            break
+        except KeyboardInterrupt:
+            # the daemon raises KeyboardInterrupt in the command, like CTRL+C would
+            conn.sendall(b'interrupt\n')
+    if reply is None:
+        sys.stderr.write("tfpromote daemon closed the connection\n")
+        return 1
+    if reply.startswith('exit '):
+        return int(reply[len('exit '):])
+    # e.g. a daemon running a different version
+    return None
+
+
+def main():
+    argv = sys.argv[1:]
+    if daemon_supported() and '--daemon' not in argv and '--no-daemon' not in argv:
+        conn = connect(get_socket_path())
+        if conn is not None:
+            try:
+                exit_code = run_in_daemon(conn, argv)
+            finally:
+                conn.close()
+            if exit_code is not None:
+                sys.exit(exit_code)
+    from .tfpromote import main as run_main
+    run_main()
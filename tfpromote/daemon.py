@@ -0,0 +1,218 @@
+import os
+import sys
+import array
+import atexit
+import signal
+import socket
+import marshal
+import logging
+import threading
+import traceback
+from . import client
+from . import timings
+from . import snapshot
+from . import fingerprint_cache
+from .version import __version__
+
+logger = logging.getLogger(__name__)
+
+
+def receive_request(conn):
+    '''Reads the client's request along with the stdin, stdout and stderr file
+    descriptors sent with it.'''
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    length = int.from_bytes(data[:client.REQUEST_LENGTH_SIZE], 'big')
+    while data and len(data) < client.REQUEST_LENGTH_SIZE + length:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    if len(fds) != 3 or len(data) != client.REQUEST_LENGTH_SIZE + length:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError("Incomplete request")
+    return marshal.loads(data[client.REQUEST_LENGTH_SIZE:]), list(fds)
+
+
+def forward_interrupts(conn, running):
+    '''Raises KeyboardInterrupt in the command being run when the client is
+    interrupted, or goes away, until the command finishes.'''
+    while True:
+        try:
+            message = client.read_line(conn)
+        except (IOError, OSError):
+            message = None
+        if running.is_set():
+            # a real signal, so that blocking calls like select are interrupted too
+            os.kill(os.getpid(), signal.SIGINT)
+        if message is None:
+            return
+
+
+class ClientContext(object):
+    '''Runs the with block as if it were the client's process: its stdin, stdout and
+    stderr (including for child processes such as the difftool), working directory,
+    environment and arguments.  Everything is put back afterwards.'''
+
+    def __init__(self, request, fds):
+        self.request = request
+        self.fds = fds
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.saved_fds = [os.dup(fd) for fd in (0, 1, 2)]
+        self.saved_files = (sys.stdin, sys.stdout, sys.stderr)
+        self.saved_cwd = os.getcwd()
+        self.saved_environ = dict(os.environ)
+        self.saved_argv = sys.argv
+        for fd, client_fd in enumerate(self.fds):
+            os.dup2(client_fd, fd)
+        # new file objects so nothing buffered for an earlier client is seen
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', closefd=False)
+        os.environ.clear()
+        os.environ.update(self.request['env'])
+        os.chdir(self.request['cwd'])
+        sys.argv = ['tfpromote'] + self.request['argv']
+        logging.getLogger().setLevel(os.environ.get("LOGLEVEL", "WARNING"))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for f in (sys.stdout, sys.stderr):
+            try:
+                f.flush()
+            except (IOError, OSError, ValueError):
+                pass
+        sys.stdin, sys.stdout, sys.stderr = self.saved_files
+        for fd, saved_fd in enumerate(self.saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        for client_fd in self.fds:
+            os.close(client_fd)
+        sys.argv = self.saved_argv
+        os.chdir(self.saved_cwd)
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        logging.getLogger().setLevel(os.environ.get("LOGLEVEL", "WARNING"))
+        return False
+
+
+def exit_code(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def run_command(main):
+    '''Runs main() and returns its exit code, the way the interpreter would for a
+    standalone run.'''
+    try:
+        main()
+        return 0
+    except SystemExit as e:
+        return exit_code(e)
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        # what atexit would have done at the end of a standalone run
+        timings.finish()
+        atexit.unregister(timings.finish)
+        snapshot.remove_temp_directories()
+
+
+def handle(conn, main):
+    request, fds = receive_request(conn)
+    if request.get('version') != __version__:
+        # the client runs the command itself instead
+        for fd in fds:
+            os.close(fd)
+        conn.sendall("version {}\n".format(__version__).encode('utf-8'))
+        return
+    running = threading.Event()
+    interrupts = threading.Thread(target=forward_interrupts, args=(conn, running))
+    interrupts.daemon = True
+    interrupts.start()
+    with ClientContext(request, fds):
+        running.set()
+        try:
+            code = run_command(main)
+        finally:
+            running.clear()
+    try:
+        conn.sendall("exit {}\n".format(code).encode('utf-8'))
+    except (IOError, OSError) as e:
+        logger.info("Client went away: {}".format(e))
+    logger.info("Ran {} in {}, exit code {}".format(
+        request['argv'], request['cwd'], code))
+
+
+def listen(socket_path):
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.lexists(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+    problem = client.check_socket_directory(socket_dir)
+    if problem:
+        raise Exception("Refusing to listen on {}: {}".format(socket_path, problem))
+    if os.path.lexists(socket_path):
+        problem = client.check_socket(socket_path)
+        if problem:
+            raise Exception("Refusing to listen on {}: {}".format(socket_path, problem))
+        # left behind by a daemon that didn't shut down cleanly, unless one is running
+        conn = client.connect(socket_path)
+        if conn is not None:
+            conn.close()
+            raise Exception("A tfpromote daemon is already listening on {}".format(socket_path))
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only this user may connect
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    return server
+
+
+def serve(main, socket_path=None):
+    '''Runs main() for each command sent by a client, one at a time, until interrupted.
+    Fingerprint caches stay loaded in memory between commands, their entries are
+    checked against each file's size and mtime as usual.  Directory snapshots are
+    taken again for each command as a file changing in place doesn't change its
+    directory's mtime.'''
+    socket_path = socket_path or client.get_socket_path()
+    server = listen(socket_path)
+    fingerprint_cache.keep_caches_warm()
+    # started in the background SIGINT may be ignored, forwarded interrupts rely on it
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    print("tfpromote daemon {} listening on {}, press CTRL+C to stop.".format(
+        __version__, socket_path))
+    sys.stdout.flush()
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                handle(conn, main)
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                logger.error("Error running command: {}".format(e))
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        print("\nStopped tfpromote daemon.")
+    finally:
+        server.close()
+        os.remove(socket_path)
@@ -0,0 +1,357 @@
+import os
+import bisect
+import difflib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# lines appearing more often than this in a region aren't used to anchor a histogram
+# diff, e.g. '}' in a .tf file
+MAX_OCCURRENCES = 64
+# a Myers diff of a region with no anchors gives up after this many edits and treats
+# the whole region as changed, so repetitive input can't make it quadratic
+MAX_MYERS_EDITS = 1000
+
+
+class DifflibEngine(object):
+    '''difflib.SequenceMatcher, as difflib.unified_diff uses.'''
+    name = 'difflib'
+
+    def matching_blocks(self, a, b):
+        return difflib.SequenceMatcher(None, a, b).get_matching_blocks()
+
+
+class HistogramEngine(object):
+    '''A histogram diff, like git diff --histogram.  Each region of the files is first
+    anchored on every line which occurs exactly once on both sides, in one pass (as a
+    patience diff does), and the diff is repeated on the gaps between those anchors.
+    Regions with no unique lines are anchored on the run of common lines which occur
+    the fewest times.  Lines are counted with a dict, so however many hunks there are
+    this stays close to linear in the size of the files, where difflib can go
+    quadratic on files with many repeated lines.  Regions with no usable anchor at all
+    are diffed with Myers' algorithm, bounded by MAX_MYERS_EDITS.'''
+    name = 'histogram'
+
+    def matching_blocks(self, a, b):
+        blocks = []
+        regions = [(0, len(a), 0, len(b))]
+        while regions:
+            alo, ahi, blo, bhi = regions.pop()
+            # common prefix and suffix
+            size = 0
+            while alo + size < ahi and blo + size < bhi and a[alo + size] == b[blo + size]:
+                size += 1
+            if size:
+                blocks.append((alo, blo, size))
+                alo += size
+                blo += size
+            size = 0
+            while alo < ahi - size and blo < bhi - size and \
+                    a[ahi - size - 1] == b[bhi - size - 1]:
+                size += 1
+            if size:
+                blocks.append((ahi - size, bhi - size, size))
+                ahi -= size
+                bhi -= size
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = unique_anchors(a, b, alo, ahi, blo, bhi)
+            if anchors:
+                for i, j in anchors:
+                    blocks.append((i, j, 1))
+                    regions.append((alo, i, blo, j))
+                    alo, blo = i + 1, j + 1
+                regions.append((alo, ahi, blo, bhi))
+                continue
+
+            anchor = find_anchor(a, b, alo, ahi, blo, bhi)
+            if anchor is None:
+                blocks.extend(myers_blocks(a, b, alo, ahi, blo, bhi))
+                continue
+            i, j, size = anchor
+            blocks.append(anchor)
+            regions.append((alo, i, blo, j))
+            regions.append((i + size, ahi, j + size, bhi))
+        return merge_blocks(blocks, len(a), len(b))
+
+
+def unique_anchors(a, b, alo, ahi, blo, bhi):
+    '''Returns (i, j) of lines occurring exactly once in both a[alo:ahi] and b[blo:bhi],
+    the longest sequence of them in the same order on both sides, found with patience
+    sorting in O(n log n).'''
+    # line -> [occurrences in a, position in a, occurrences in b]
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, i, 0]
+        else:
+            entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+    # (j, i) in b order
+    pairs = []
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None and entry[0] == 1 and entry[2] == 1:
+            pairs.append((j, entry[1]))
+
+    # the longest increasing subsequence of the positions in a
+    tails = []
+    tail_indexes = []
+    previous = []
+    for index, (j, i) in enumerate(pairs):
+        length = bisect.bisect_left(tails, i)
+        if length == len(tails):
+            tails.append(i)
+            tail_indexes.append(index)
+        else:
+            tails[length] = i
+            tail_indexes[length] = index
+        previous.append(tail_indexes[length - 1] if length else None)
+    anchors = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        j, i = pairs[index]
+        anchors.append((i, j))
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def find_anchor(a, b, alo, ahi, blo, bhi):
+    '''Returns the (i, j, size) run of matching lines whose rarest line occurs the
+    fewest times in a[alo:ahi], preferring longer runs, or None if every common line
+    occurs more than MAX_OCCURRENCES times.'''
+    occurrences = {}
+    for i in range(alo, ahi):
+        occurrences.setdefault(a[i], []).append(i)
+    best = None
+    j = blo
+    while j < bhi:
+        next_j = j + 1
+        positions = occurrences.get(b[j])
+        if positions is not None and len(positions) <= MAX_OCCURRENCES:
+            for i in positions:
+                count = len(positions)
+                start_i, start_j = i, j
+                while start_i > alo and start_j > blo and a[start_i - 1] == b[start_j - 1]:
+                    start_i -= 1
+                    start_j -= 1
+                    count = min(count, len(occurrences[a[start_i]]))
+                end_i, end_j = i + 1, j + 1
+                while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                    count = min(count, len(occurrences[a[end_i]]))
+                    end_i += 1
+                    end_j += 1
+                size = end_i - start_i
+                if best is None or count < best[0] or (count == best[0] and size > best[3]):
+                    best = (count, start_i, start_j, size)
+                # lines of b inside this run can't start a better one
+                next_j = max(next_j, end_j)
+        j = next_j
+    if best is None:
+        return None
+    return best[1:]
+
+
+def myers_blocks(a, b, alo, ahi, blo, bhi, max_edits=MAX_MYERS_EDITS):
+    '''Matching blocks of a[alo:ahi] and b[blo:bhi] from Myers' O(ND) algorithm, or no
+    blocks at all if more than max_edits lines are different.'''
+    n = ahi - alo
+    m = bhi - blo
+    v = {1: 0}
+    trace = []
+    for d in range(min(n + m, max_edits) + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return myers_backtrack(trace, n, m, alo, blo)
+    logger.debug("More than {} lines different, not aligning {} lines".format(
+        max_edits, n + m))
+    return []
+
+
+def myers_backtrack(trace, x, y, alo, blo):
+    blocks = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        size = 0
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            size += 1
+        if size:
+            blocks.append((alo + x, blo + y, size))
+        x, y = prev_x, prev_y
+    return blocks
+
+
+def merge_blocks(blocks, a_length, b_length):
+    '''Sorts blocks, joins adjacent ones and adds the (len(a), len(b), 0) sentinel, the
+    same form as SequenceMatcher.get_matching_blocks.'''
+    merged = []
+    for i, j, size in sorted(blocks):
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((i, j, size))
+    merged.append((a_length, b_length, 0))
+    return merged
+
+
+def get_opcodes(blocks):
+    '''Like SequenceMatcher.get_opcodes for the given matching blocks.'''
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+
+def get_grouped_opcodes(opcodes, n=3):
+    '''Like SequenceMatcher.get_grouped_opcodes, hunks of changes with up to n lines of
+    context.'''
+    if not opcodes:
+        opcodes = [('equal', 0, 1, 0, 1)]
+    opcodes = list(opcodes)
+    if opcodes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if opcodes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    nn = n + n
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        # end the current group and start a new one after a large equal range
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+def format_range(start, stop):
+    '''A range in a unified diff hunk header, as difflib writes it.'''
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+
+def format_unified_diff(a, b, groups, fromfile, tofile):
+    '''Yields the lines of a unified diff of the grouped opcodes, the same as
+    difflib.unified_diff with lineterm=''.'''
+    for idx, group in enumerate(groups):
+        if idx == 0:
+            yield '--- {}'.format(fromfile)
+            yield '+++ {}'.format(tofile)
+        first, last = group[0], group[-1]
+        yield '@@ -{} +{} @@'.format(
+            format_range(first[1], last[2]), format_range(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+' + line
+
+
+def count_unified_diff(a, groups):
+    '''The number of non-blank lines format_unified_diff would yield, without
+    formatting them.  Only context lines can be blank.  The groups still come from
+    aligning all of both files, as the exact count is shown and written to plans.'''
+    if not groups:
+        return 0
+    count = 2
+    for group in groups:
+        count += 1
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                count += sum(1 for line in a[i1:i2] if line.strip())
+                continue
+            if tag in ('replace', 'delete'):
+                count += i2 - i1
+            if tag in ('replace', 'insert'):
+                count += j2 - j1
+    return count
+
+
+DIFF_ENGINES = {
+    'histogram': HistogramEngine(),
+    'difflib': DifflibEngine()
+}
+DEFAULT_DIFF_ENGINE = 'histogram'
+
+_engine_name = os.environ.get('TFPROMOTE_DIFF_ENGINE') or DEFAULT_DIFF_ENGINE
+
+
+def set_default_engine(name):
+    if name not in DIFF_ENGINES:
+        raise Exception("Unknown diff engine {}, expected one of {}".format(
+            name, ', '.join(sorted(DIFF_ENGINES))))
+    global _engine_name
+    _engine_name = name
+
+
+def get_engine(name=None):
+    '''The named engine, or the one chosen with --diff-engine or TFPROMOTE_DIFF_ENGINE.'''
+    name = name or _engine_name
+    if name not in DIFF_ENGINES:
+        logger.warning("Unknown diff engine {}, using difflib".format(name))
+        name = 'difflib'
+    return DIFF_ENGINES[name]
+
+
+def grouped_opcodes(a, b, n=3, engine=None):
+    return get_grouped_opcodes(get_opcodes(get_engine(engine).matching_blocks(a, b)), n)
+
+
+def unified_diff(a, b, fromfile='', tofile='', n=3, engine=None):
+    '''difflib.unified_diff(a, b, fromfile, tofile, n=n, lineterm='') using a diff
+    engine, see DIFF_ENGINES.'''
+    return format_unified_diff(a, b, grouped_opcodes(a, b, n, engine), fromfile, tofile)
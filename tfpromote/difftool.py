@@ -0,0 +1,98 @@
+import os
+import shlex
+import shutil
+import logging
+import tempfile
+import subprocess
+from . import timings
+
+logger = logging.getLogger(__name__)
+
+# replaced in a difftool command template, e.g. "meld {from} {to}", otherwise the two
+# paths are added after the command
+FROM_PLACEHOLDER = '{from}'
+TO_PLACEHOLDER = '{to}'
+
+
+def split_template(template):
+    # backslashes are path separators on Windows, not escapes
+    try:
+        return shlex.split(template, posix=(os.name != 'nt'))
+    except ValueError as e:
+        raise Exception("Could not parse the difftool command {}: {}".format(template, e))
+
+
+def get_executable(template):
+    '''The program a difftool command template runs, to check that it is installed.'''
+    words = split_template(template)
+    return words[0] if words else None
+
+
+def build_command(template, from_path, to_path):
+    '''Returns the argument list for running the difftool on two files or directories.
+    The template is split like a shell would, but the paths are substituted afterwards
+    so they are never interpreted by a shell.'''
+    words = split_template(template)
+    if not any(FROM_PLACEHOLDER in word or TO_PLACEHOLDER in word for word in words):
+        return words + [from_path, to_path]
+    return [word.replace(FROM_PLACEHOLDER, from_path).replace(TO_PLACEHOLDER, to_path)
+            for word in words]
+
+
+def format_command(command):
+    return ' '.join(shlex.quote(word) for word in command)
+
+
+def run_difftool(template, from_path, to_path):
+    '''Runs the difftool and waits for it to exit, returns (command, return code).'''
+    command = build_command(template, from_path, to_path)
+    with timings.span('difftool', 'wait', file=to_path):
+        try:
+            return_code = subprocess.call(command)
+        except OSError as e:
+            logger.error("Could not run {}: {}".format(command[0], e))
+            return_code = 127
+    return format_command(command), return_code
+
+
+def link_file(source_path, link_path):
+    '''Makes source_path appear at link_path without copying it, so changes made in the
+    difftool are made to the real file.  Symlinks are used where possible, then hard
+    links, and files are only copied if neither is allowed.'''
+    try:
+        os.symlink(os.path.abspath(source_path), link_path)
+        return
+    except (OSError, NotImplementedError, AttributeError):
+        pass
+    try:
+        os.link(source_path, link_path)
+        return
+    except (OSError, AttributeError):
+        pass
+    shutil.copy2(source_path, link_path)
+
+
+def build_review_trees(review_dir, files, from_name, to_name):
+    '''Creates review_dir/from_name and review_dir/to_name holding links to just the
+    files to review.  files is a list of (relative name, from file, to file).  Returns
+    the two directories.'''
+    from_dir = os.path.join(review_dir, from_name)
+    to_dir = os.path.join(review_dir, to_name)
+    for name, from_file, to_file in files:
+        for tree_dir, source_path in [(from_dir, from_file), (to_dir, to_file)]:
+            link_path = os.path.join(tree_dir, name)
+            if not os.path.isdir(os.path.dirname(link_path)):
+                os.makedirs(os.path.dirname(link_path))
+            link_file(source_path, link_path)
+    return from_dir, to_dir
+
+
+def run_dir_diff(template, files, from_name, to_name):
+    '''Launches the difftool once in directory compare mode on two temporary trees
+    holding only the files to review, returns (command, return code).'''
+    review_dir = tempfile.mkdtemp(prefix='tfpromote-review-')
+    try:
+        from_dir, to_dir = build_review_trees(review_dir, files, from_name, to_name)
+        return run_difftool(template, from_dir, to_dir)
+    finally:
+        shutil.rmtree(review_dir, ignore_errors=True)
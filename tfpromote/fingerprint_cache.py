@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from . import timings
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+# entries not used for this long are dropped when the cache is saved
+MAX_ENTRY_AGE_SECONDS = 30 * 24 * 60 * 60
+# a file modified this close to when it was hashed could change again without its
+# mtime moving, so its fingerprint isn't trusted until it is hashed again later
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+# cache path -> FingerprintCache, kept loaded between commands by the daemon
+_warm_caches = None
+
+
+def get_default_cache_path():
+    '''TFPROMOTE_CACHE_DIR if set, otherwise tfpromote under XDG_CACHE_HOME or ~/.cache.'''
+    cache_dir = os.environ.get("TFPROMOTE_CACHE_DIR")
+    if not cache_dir:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(cache_home, "tfpromote")
+    return os.path.join(cache_dir, "fingerprints.json")
+
+
+def keep_caches_warm():
+    '''Makes open_cache return the same FingerprintCache for a cache path every time
+    instead of loading it from disk again.'''
+    global _warm_caches
+    _warm_caches = {}
+
+
+def open_cache(rebuild=False):
+    if _warm_caches is None:
+        return FingerprintCache(rebuild=rebuild)
+    cache_path = get_default_cache_path()
+    cache = _warm_caches.get(cache_path)
+    if cache is None or rebuild:
+        cache = FingerprintCache(cache_path, rebuild=rebuild)
+        _warm_caches[cache_path] = cache
+    return cache
+
+
+def hash_file(path, chunk_size=65536):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class FingerprintCache(object):
+    '''Content fingerprints (sha256) of files keyed by absolute path, size and
+    mtime_ns, persisted as JSON between runs so unchanged files don't need to be
+    read again.  Safe to share between threads.'''
+
+    def __init__(self, cache_path=None, rebuild=False):
+        self.cache_path = cache_path or get_default_cache_path()
+        # path -> [size, mtime_ns, sha256, hashed_at_ns, used_at]
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        if rebuild:
+            logger.info("Rebuilding fingerprint cache {}".format(self.cache_path))
+            self.dirty = True
+        else:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.info("Not using fingerprint cache {}: {}".format(self.cache_path, e))
+            return
+        if data.get('version') != CACHE_VERSION:
+            logger.info("Ignoring fingerprint cache with version {}".format(data.get('version')))
+            return
+        self.entries = data.get('entries', {})
+
+    def save(self):
+        '''Writes the cache back to disk, dropping entries which haven't been used
+        recently.  Failing to write the cache is logged and otherwise ignored.'''
+        with self.lock:
+            if not self.dirty:
+                return
+            oldest = time.time() - MAX_ENTRY_AGE_SECONDS
+            entries = dict((path, entry) for path, entry in self.entries.items()
+                           if entry[4] >= oldest)
+            self.dirty = False
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'entries': entries}, f)
+            os.replace(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save fingerprint cache {}: {}".format(self.cache_path, e))
+        logger.info("Fingerprint cache: {} hits, {} misses, {} entries".format(
+            self.hits, self.misses, len(entries)))
+
+    def fingerprint(self, path, stat_result=None):
+        '''Returns the sha256 of the file at path, only reading the file if its size or
+        mtime changed since it was last fingerprinted.'''
+        path = os.path.abspath(path)
+        if stat_result is None:
+            stat_result = os.stat(path)
+        size = stat_result.st_size
+        mtime_ns = stat_result.st_mtime_ns
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == size and entry[1] == mtime_ns and \
+                    entry[3] - mtime_ns > RACY_NS:
+                entry[4] = time.time()
+                self.hits += 1
+                self.dirty = True
+                return entry[2]
+        hashed_at_ns = int(time.time() * 1e9)
+        with timings.span('hash file', 'file', file=path, bytes=size):
+            sha = hash_file(path)
+        with self.lock:
+            self.entries[path] = [size, mtime_ns, sha, hashed_at_ns, time.time()]
+            self.misses += 1
+            self.dirty = True
+        return sha
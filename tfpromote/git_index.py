@@ -0,0 +1,151 @@
+import os
+import logging
+import subprocess
+from .snapshot import as_snapshot, FileFilter, split_env_files, make_temp_directory
+
+logger = logging.getLogger(__name__)
+
+
+class GitError(Exception):
+    pass
+
+
+def run_git(directory, git_args, stdin=None):
+    '''Runs git in directory and returns its stdout as bytes.'''
+    try:
+        process = subprocess.Popen(
+            ['git', '-C', directory] + git_args,
+            stdin=subprocess.PIPE if stdin is not None else None,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise GitError("Could not run git: {}".format(e))
+    stdout, stderr = process.communicate(stdin)
+    if process.returncode != 0:
+        raise GitError("git {} failed in {}: {}".format(
+            ' '.join(git_args), directory, stderr.decode('utf-8', 'replace').strip()))
+    return stdout
+
+
+def split_z(output):
+    '''Splits the NUL terminated records of git's -z output.'''
+    return [record.decode('utf-8', 'surrogateescape') for record in output.split(b'\0') if record]
+
+
+def native_path(git_path):
+    '''git always separates directories with /.'''
+    return git_path.replace('/', os.sep)
+
+
+def read_blob_ids(directory):
+    '''Returns {filename: blob id} for the files in and under directory whose working
+    copy matches the git index, using the stat data git keeps there.  Untracked,
+    modified and conflicted files are left out, they need to be compared as files.'''
+    blob_ids = {}
+    conflicted = set()
+    for record in split_z(run_git(directory, ['ls-files', '-s', '-z', '--', '.'])):
+        info, filename = record.split('\t', 1)
+        _, blob_id, stage = info.split(' ')
+        filename = native_path(filename)
+        if stage != '0':
+            conflicted.add(filename)
+        blob_ids[filename] = blob_id
+    modified = set(native_path(filename) for filename in
+                   split_z(run_git(directory, ['ls-files', '-m', '-z', '--', '.'])))
+    for filename in modified | conflicted:
+        blob_ids.pop(filename, None)
+    return blob_ids
+
+
+def load_blob_ids(directory):
+    '''Returns a snapshot of directory (a path or snapshot) whose clean tracked files
+    are compared by their git blob ids.  If git can't be used the snapshot is returned
+    without them and files are compared as usual.'''
+    snapshot = as_snapshot(directory)
+    if snapshot.blob_ids:
+        return snapshot
+    try:
+        blob_ids = read_blob_ids(snapshot.directory)
+    except GitError as e:
+        logger.warning("Not using the git index for {}: {}".format(snapshot.directory, e))
+        return snapshot
+    # only for files the snapshot has, in case they changed between the two listings
+    snapshot.blob_ids = dict((filename, blob_id) for filename, blob_id in blob_ids.items()
+                             if snapshot.has(filename))
+    logger.info("{} of {} files in {} are clean in the git index".format(
+        len(snapshot.blob_ids), len(snapshot.stats), snapshot.directory))
+    return snapshot
+
+
+def read_blobs(directory, blob_ids):
+    '''Yields (blob id, contents) for each blob, read with a single git cat-file.'''
+    output = run_git(directory, ['cat-file', '--batch'],
+                     stdin=''.join(blob_id + '\n' for blob_id in blob_ids).encode('ascii'))
+    offset = 0
+    while offset < len(output):
+        header_end = output.index(b'\n', offset)
+        blob_id, kind, size = output[offset:header_end].decode('ascii').split(' ')
+        if kind != 'blob':
+            raise GitError("Expected a blob for {}, got {}".format(blob_id, kind))
+        start = header_end + 1
+        yield blob_id, output[start:start + int(size)]
+        # contents are followed by a newline
+        offset = start + int(size) + 1
+
+
+class GitRevisionSnapshot(object):
+    '''The .tf files of a directory as of a git revision (a commit, branch or tag), with
+    the same interface and options as DirectorySnapshot.  The files are written to a
+    temporary directory (see make_temp_directory), so they can be diffed and promoted like
+    any other file.'''
+
+    def __init__(self, directory, revision, recursive=False, include=None, exclude=None):
+        self.source_directory = directory
+        self.revision = revision
+        self.env_name = os.path.basename(os.path.normpath(directory))
+        self.env_name = self.env_name.split('-')[0] # '/dev/', '/dev-us-east-1/' -> 'dev'
+        self.env_prefix = "{}-".format(self.env_name)
+
+        self.file_filter = FileFilter(recursive, include, exclude)
+
+        blob_ids = {}
+        ls_tree = ['ls-tree', '-r', '-z'] if recursive else ['ls-tree', '-z']
+        for record in split_z(run_git(directory, ls_tree + [revision, '--', '.'])):
+            info, filename = record.split('\t', 1)
+            _, kind, blob_id = info.split(' ')
+            filename = native_path(filename)
+            if kind == 'blob' and self.file_filter.wants(filename):
+                blob_ids[filename] = blob_id
+        if not blob_ids:
+            raise GitError("No files to promote in {} at {}".format(directory, revision))
+
+        self.directory = make_temp_directory('tfpromote-{}-'.format(
+            ''.join(c if c.isalnum() else '-' for c in revision)))
+        contents = dict(read_blobs(directory, sorted(set(blob_ids.values()))))
+        self.stats = {}
+        for filename, blob_id in blob_ids.items():
+            path = os.path.join(self.directory, filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(contents[blob_id])
+            self.stats[filename] = os.stat(path)
+        self.blob_ids = blob_ids
+
+        self.nonenv_files, self.env_files = split_env_files(blob_ids, self.env_prefix)
+        self.nonenv_set = set(self.nonenv_files)
+        self.env_set = set(self.env_files)
+
+    def has(self, filename):
+        return filename in self.stats
+
+    def stat(self, filename):
+        return self.stats[filename]
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def blob_id(self, filename):
+        return self.blob_ids.get(filename)
+
+    def sha256(self, filename):
+        return None
@@ -0,0 +1,179 @@
+import re
+import hashlib
+import logging
+import itertools
+from collections import namedtuple
+from . import diff_engines
+
+logger = logging.getLogger(__name__)
+
+# key is e.g. 'resource "aws_iam_role" "task"' for a block or 'name =' for a top-level
+# attribute, start is the index of the block's first line in the file
+Block = namedtuple('Block', ['key', 'start', 'lines', 'digest'])
+
+ATTRIBUTE_RE = re.compile(r'^([A-Za-z_][\w-]*)\s*=')
+HEREDOC_RE = re.compile(r'<<-?([A-Za-z_]\w*)\s*$')
+HUNK_RE = re.compile(r'^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@$')
+
+
+class ScanState(object):
+    def __init__(self):
+        self.depth = 0
+        self.heredoc = None
+        self.in_comment = False
+
+    def at_top_level(self):
+        return self.depth == 0 and self.heredoc is None and not self.in_comment
+
+
+def scan_line(line, state):
+    '''Updates the bracket depth in state for one line of HCL, skipping over strings,
+    comments and heredocs.'''
+    if state.heredoc is not None:
+        if line.strip() == state.heredoc:
+            state.heredoc = None
+        return
+    in_string = False
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if state.in_comment:
+            if line.startswith('*/', i):
+                state.in_comment = False
+                i += 1
+        elif in_string:
+            if c == '\\':
+                i += 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '#' or line.startswith('//', i):
+            break
+        elif line.startswith('/*', i):
+            state.in_comment = True
+            i += 1
+        elif line.startswith('<<', i):
+            match = HEREDOC_RE.match(line, i)
+            if match:
+                state.heredoc = match.group(1)
+                break
+        elif c in '{[(':
+            state.depth += 1
+        elif c in '}])':
+            state.depth -= 1
+            if state.depth < 0:
+                raise ValueError("Unbalanced '{}'".format(c))
+        i += 1
+
+
+def block_key(line):
+    stripped = line.strip()
+    match = ATTRIBUTE_RE.match(stripped)
+    if match:
+        return "{} =".format(match.group(1))
+    return re.sub(r'\s+', ' ', stripped.split('{', 1)[0]).strip()
+
+
+def make_block(key, start, lines):
+    # blank lines around a block don't matter, so moving it doesn't change it
+    while lines and not lines[0].strip():
+        lines = lines[1:]
+        start += 1
+    while lines and not lines[-1].strip():
+        lines = lines[:-1]
+    digest = hashlib.sha1(''.join(lines).encode('utf-8', 'replace')).hexdigest()
+    return Block(key, start, lines, digest)
+
+
+def split_blocks(lines):
+    '''Splits the lines of an HCL file into its top-level blocks and attributes, in file
+    order.  Comments and blank lines before a block belong to it.  Raises ValueError if
+    the brackets don't balance, e.g. for syntax this scanner doesn't understand.'''
+    blocks = []
+    state = ScanState()
+    key = None
+    start = 0
+    for idx, line in enumerate(lines):
+        was_top_level = state.at_top_level()
+        scan_line(line, state)
+        if key is None and was_top_level:
+            stripped = line.strip()
+            if stripped and not stripped.startswith(('#', '//', '/*')):
+                key = block_key(line)
+        if key is not None and state.at_top_level():
+            blocks.append(make_block(key, start, lines[start:idx + 1]))
+            key = None
+            start = idx + 1
+    if not state.at_top_level():
+        raise ValueError("Unexpected end of file inside a block")
+    if start < len(lines):
+        # comments after the last block
+        block = make_block('(end of file)', start, lines[start:])
+        if block.lines:
+            blocks.append(block)
+    return blocks
+
+
+def index_blocks(blocks):
+    '''Returns an ordered list of unique keys and a key -> Block dict.  Repeated keys
+    (e.g. several locals blocks) are numbered in the order they appear.'''
+    keys = []
+    by_key = {}
+    for block in blocks:
+        key = block.key
+        occurrence = 2
+        while key in by_key:
+            key = "{} #{}".format(block.key, occurrence)
+            occurrence += 1
+        keys.append(key)
+        by_key[key] = block
+    return keys, by_key
+
+
+def offset_hunk_header(line, from_block, to_block, key):
+    '''Hunks number lines from the start of the block, renumber them from the start of
+    the file and name the block the hunk is in, like git's function context.'''
+    match = HUNK_RE.match(line)
+    if not match:
+        return line
+    from_start = int(match.group(1)) + (from_block.start if from_block else 0)
+    to_start = int(match.group(3)) + (to_block.start if to_block else 0)
+    return "@@ -{}{} +{}{} @@ {}".format(
+        from_start, match.group(2) or '', to_start, match.group(4) or '', key)
+
+
+def unified_block_diff(from_lines, to_lines, fromfile, tofile, n=3):
+    '''Like diff_engines.unified_diff, but only diffs the top-level blocks whose contents
+    changed.  Blocks are matched by their type and labels so reordering them isn't a
+    change.  Falls back to a plain line diff if either file can't be split into blocks.'''
+    try:
+        from_keys, from_blocks = index_blocks(split_blocks(from_lines))
+        to_keys, to_blocks = index_blocks(split_blocks(to_lines))
+    except ValueError as e:
+        logger.info("Falling back to a line diff of {}: {}".format(fromfile, e))
+        for line in diff_engines.unified_diff(
+                from_lines, to_lines, fromfile=fromfile, tofile=tofile):
+            yield line
+        return
+
+    keys = from_keys + [key for key in to_keys if key not in from_blocks]
+    headers_done = False
+    for key in keys:
+        from_block = from_blocks.get(key)
+        to_block = to_blocks.get(key)
+        if from_block and to_block and from_block.digest == to_block.digest:
+            continue
+        if not headers_done:
+            yield '--- {}'.format(fromfile)
+            yield '+++ {}'.format(tofile)
+            headers_done = True
+        hunks = diff_engines.unified_diff(
+            from_block.lines if from_block else [],
+            to_block.lines if to_block else [],
+            n=n)
+        # skip the ---/+++ headers, they were given once for the file above
+        for line in itertools.islice(hunks, 2, None):
+            if line.startswith('@@'):
+                line = offset_hunk_header(line, from_block, to_block, key)
+            yield line
@@ -0,0 +1,118 @@
+import os
+import json
+import logging
+from .fingerprint_cache import hash_file
+from .transaction import PromotionTransaction
+from .snapshot import add_prefix
+from . import promote_tool
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+def file_fingerprint(path, fingerprints=None):
+    if fingerprints is not None:
+        return fingerprints.fingerprint(path)
+    return hash_file(path)
+
+
+def plan_promotion(promotion, fingerprints=None):
+    '''Turns an analyzed promotion (with counted diffs, see count_promotion_diffs) into
+    the JSON serializable plan entry for one from/to directory pair.  Modified files are
+    recorded with the hashes of the contents that were diffed, so a file changing after
+    it was diffed can't be applied.'''
+    from_snapshot = promotion['from_snapshot']
+    to_snapshot = promotion['to_snapshot']
+    diff_sha256s = promotion.get('diff_sha256s', {})
+
+    def diffed_sha256(filename, side, snapshot):
+        if filename in diff_sha256s:
+            return diff_sha256s[filename][side]
+        return file_fingerprint(snapshot.path(filename), fingerprints)
+
+    return {
+        'from_path': promotion['from_path'],
+        'from_env': promotion['from_env'],
+        'to_path': promotion['to_path'],
+        'to_env': promotion['to_env'],
+        'new_files': [{
+            'filename': filename,
+            'from_sha256': file_fingerprint(from_snapshot.path(filename), fingerprints)
+        } for filename in promotion['new_files']],
+        'modified_files': [{
+            'filename': filename,
+            'lines_different': line_count,
+            'from_sha256': diffed_sha256(filename, 0, from_snapshot),
+            'to_sha256': diffed_sha256(filename, 1, to_snapshot)
+        } for filename, line_count in promotion['diffs']],
+        # env files are only reported, they are never promoted
+        'env_diffs': [{
+            'from_filename': add_prefix(from_snapshot.env_prefix, filename),
+            'to_filename': add_prefix(to_snapshot.env_prefix, filename),
+            'lines_different': line_count
+        } for filename, line_count in promotion['env_diffs']],
+        'ignored_files': promotion['missing_files'] + promotion['missing_env_files'] + \
+            promotion['new_env_files']
+    }
+
+
+def write_plan(plan_path, promotions, version):
+    plan = {
+        'version': PLAN_VERSION,
+        'tfpromote_version': version,
+        'promotions': promotions
+    }
+    with open(plan_path, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+
+
+def load_plan(plan_path):
+    with open(plan_path, 'r') as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise Exception("Unsupported plan version {} in {}, expected {}".format(
+            plan.get('version'), plan_path, PLAN_VERSION))
+    return plan
+
+
+def check_plan(plan, fingerprints=None):
+    '''Compares the files listed in a plan with what is on disk now.  Returns a list of
+    messages describing every file that changed since the plan was made, empty if the
+    plan can be applied as is.'''
+    drifted = []
+    for entry in plan['promotions']:
+        for new_file in entry['new_files']:
+            from_filename = os.path.join(entry['from_path'], new_file['filename'])
+            to_filename = os.path.join(entry['to_path'], new_file['filename'])
+            if not os.path.isfile(from_filename):
+                drifted.append("{} no longer exists".format(from_filename))
+            elif file_fingerprint(from_filename, fingerprints) != new_file['from_sha256']:
+                drifted.append("{} changed".format(from_filename))
+            if os.path.exists(to_filename):
+                drifted.append("{} was created".format(to_filename))
+        for modified_file in entry['modified_files']:
+            for path, key in [(entry['from_path'], 'from_sha256'), (entry['to_path'], 'to_sha256')]:
+                filename = os.path.join(path, modified_file['filename'])
+                if not os.path.isfile(filename):
+                    drifted.append("{} no longer exists".format(filename))
+                elif file_fingerprint(filename, fingerprints) != modified_file[key]:
+                    drifted.append("{} changed".format(filename))
+    return drifted
+
+
+def apply_plan(plan):
+    '''Promotes every file listed in the plan in one PromotionTransaction.  Each file is
+    hashed again as it is staged, if any no longer matches the plan nothing is
+    promoted.'''
+    with PromotionTransaction() as transaction:
+        for entry in plan['promotions']:
+            files = entry['new_files'] + entry['modified_files']
+            if files:
+                print("Promoting into {}".format(entry['to_path']))
+            promote_tool.stage_files(
+                transaction, [f['filename'] for f in files], entry['from_path'],
+                entry['to_path'], sha256s=dict((f['filename'], f['from_sha256']) for f in files))
+        transaction.commit()
+    print(transaction.summary())
+    return transaction
@@ -1,11 +1,17 @@
+import io
 import os
 import sys
 import logging
-import difflib
-import shutil
-import codecs
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from . import hcl_blocks
+from . import diff_engines
+from .snapshot import DirectorySnapshot, as_snapshot, add_prefix
+from .transaction import PromotionTransaction
+from .fingerprint_cache import hash_file
+from . import timings
 
-logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
 logger = logging.getLogger(__name__)
 
 
@@ -49,55 +55,271 @@ def get_lower_environment(env_name):
     return env_names[env_idx - 1]
 
 
+def get_environment_chain(start_env, end_env):
+    '''Returns the environments in TFPROMOTE_ENVS from start_env up to end_env inclusive,
+    e.g. dev, stage, prod.'''
+    env_names = get_env_names()
+    for env_name in (start_env, end_env):
+        if env_name not in env_names:
+            raise Exception("Environment ('{}') does not match any environment in TFPROMOTE_ENVS".format(env_name))
+    start_idx = env_names.index(start_env)
+    end_idx = env_names.index(end_env)
+    if start_idx >= end_idx:
+        raise Exception("{} is not a lower environment than {}.".format(start_env, end_env))
+    return env_names[start_idx:end_idx + 1]
+
+
+@timings.traced()
+def find_env_directory_pairs(root_path, to_env):
+    '''Walks root_path looking for environment directories named for to_env (e.g. stage
+    or stage-us-east-1) and pairs each one with its lower environment sibling.  Regional
+    directories prefer the lower environment in the same region (dev-us-east-1) and fall
+    back to the plain lower environment (dev).  Returns a sorted list of
+    (from_path, to_path) tuples.'''
+    from_env = get_lower_environment(to_env)
+    pairs = []
+    for dirpath, dirnames, _ in os.walk(root_path):
+        # never descend into .terraform, .git, etc.
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        env_dirnames = [d for d in dirnames if is_env_path_valid(d)]
+        for dirname in env_dirnames:
+            # env directories hold terraform, not more services
+            dirnames.remove(dirname)
+            if dirname.split('-')[0] != to_env:
+                continue
+            region_suffix = dirname[len(to_env):] # '', '-us-east-1'
+            for candidate in (from_env + region_suffix, from_env):
+                from_path = os.path.join(dirpath, candidate)
+                if os.path.isdir(from_path):
+                    pairs.append((from_path, os.path.join(dirpath, dirname)))
+                    break
+            else:
+                logger.info("No {} directory found to promote into {}".format(
+                    from_env, os.path.join(dirpath, dirname)))
+    return sorted(pairs)
+
+
+def find_regional_directories(base_path, env_name):
+    '''Returns the sorted paths of the directories in base_path for env_name, e.g.
+    stage-us-east-1 and stage-eu-west-1 (and stage itself if it exists).'''
+    if env_name not in get_env_names():
+        raise Exception("Environment ('{}') does not match any environment in TFPROMOTE_ENVS".format(env_name))
+    return sorted(
+        os.path.join(base_path, dirname) for dirname in os.listdir(base_path)
+        if dirname.split('-')[0] == env_name and os.path.isdir(os.path.join(base_path, dirname)))
+
+
+def find_environment_base_directories(root_path):
+    '''Walks root_path for directories holding environment directories (e.g. each
+    service's terraform directory), returns them sorted.'''
+    base_paths = []
+    for dirpath, dirnames, _ in os.walk(root_path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        env_dirnames = [d for d in dirnames if is_env_path_valid(d)]
+        if env_dirnames:
+            base_paths.append(dirpath)
+        for dirname in env_dirnames:
+            dirnames.remove(dirname)
+    return base_paths
+
+
+@timings.traced()
+def environment_status(base_path, fingerprints=None, snapshot_options=None):
+    '''Fingerprints every non-env .tf file once in each environment directory of
+    base_path, in TFPROMOTE_ENVS order with regional directories after their environment.
+    Returns the list of directory names and a dict of filename -> list of sha256 (None
+    where the file is missing) in the same order.  snapshot_options are passed to
+    DirectorySnapshot, e.g. recursive.'''
+    env_paths = []
+    for env_name in get_env_names():
+        env_paths.extend(find_regional_directories(base_path, env_name))
+    snapshots = [DirectorySnapshot(env_path, **(snapshot_options or {}))
+                 for env_path in env_paths]
+    filenames = sorted(set().union(*[snapshot.nonenv_set for snapshot in snapshots]))
+    status = {}
+    for filename in filenames:
+        status[filename] = []
+        for snapshot in snapshots:
+            if not snapshot.has(filename):
+                status[filename].append(None)
+            elif fingerprints is not None:
+                status[filename].append(
+                    fingerprints.fingerprint(snapshot.path(filename), snapshot.stat(filename)))
+            else:
+                status[filename].append(hash_file(snapshot.path(filename)))
+    return [os.path.basename(env_path) for env_path in env_paths], status
+
+
+@timings.traced()
 def get_nonenv_tf_files_in_directory(directory):
-    env_name = os.path.basename(os.path.normpath(directory))
-    env_name = env_name.split('-')[0] # '/dev/', '/dev-us-east-1/' -> 'dev'
-    filenames = []
-    for file in os.listdir(directory):
-        if file.endswith(".tf"):
-            envprefix = "{}-".format(env_name)
-            if not file.startswith(envprefix):
-                filenames.append(file)
-    logger.info("Found {} non-env .tf files in {}".format(len(filenames), directory))
-    return filenames
+    return DirectorySnapshot(directory).nonenv_files
 
 
+@timings.traced()
 def get_env_tf_files_in_directory(directory):
     '''Finds all .tf files named in format env-whatever.tf and returns the list of files
     with the env- part removed.  Key assumption - that the last folder in the directory
     structure is also the name of the environment.'''
-    env_name = os.path.basename(os.path.normpath(directory))
-    env_name = env_name.split('-')[0] # '/dev/', '/dev-us-east-1/' -> 'dev'
-    filenames = []
-    for file in os.listdir(directory):
-        if file.endswith(".tf"):
-            envprefix = "{}-".format(env_name)
-            if file.startswith(envprefix):
-                filenames.append(file.replace(envprefix, ''))
-    logger.info("Found {} non-env .tf files in {}".format(len(filenames), directory))
-    return filenames
-    
+    return DirectorySnapshot(directory).env_files
 
 
+@timings.traced()
 def validate_filenames(from_files, to_files):
-    from_has_to_doesnt = [ f for f in from_files if f not in to_files ]
-    to_has_from_doesnt = [ f for f in to_files if f not in from_files ]
+    from_set = set(from_files)
+    to_set = set(to_files)
+    from_has_to_doesnt = [ f for f in from_files if f not in to_set ]
+    to_has_from_doesnt = [ f for f in to_files if f not in from_set ]
 
     return from_has_to_doesnt, to_has_from_doesnt
 
 
-def diff_files(file1_path, file2_path):
-    with codecs.open(file1_path, 'r', errors='ignore') as file1:
-        file1_lines = file1.readlines()
-    with codecs.open(file2_path, 'r', errors='ignore') as file2:
-        file2_lines = file2.readlines()
+def files_identical(file1_path, file2_path, chunk_size=65536, check_size=True):
+    '''Returns True if both files have exactly the same bytes.  Sizes are checked first
+    (unless the caller already did) so most changed files are rejected without being
+    opened, otherwise the files are compared a chunk at a time and stop at the first
+    difference.'''
+    if check_size and os.path.getsize(file1_path) != os.path.getsize(file2_path):
+        return False
+    with open(file1_path, 'rb') as file1, open(file2_path, 'rb') as file2:
+        while True:
+            chunk1 = file1.read(chunk_size)
+            chunk2 = file2.read(chunk_size)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
 
-    difflines = difflib.unified_diff(
+DIFF_MODES = ['line', 'block']
+
+
+def decode_lines(contents):
+    '''The lines of a file's bytes, skipping anything that can't be decoded.'''
+    return io.TextIOWrapper(io.BytesIO(contents), errors='ignore').readlines()
+
+
+def read_lines(path):
+    with open(path, 'rb') as f:
+        return decode_lines(f.read())
+
+
+def read_lines_and_sha256(path):
+    '''read_lines along with the sha256 of the bytes the lines were read from.'''
+    with open(path, 'rb') as f:
+        contents = f.read()
+    return decode_lines(contents), hashlib.sha256(contents).hexdigest()
+
+
+def diff_files(file1_path, file2_path, diff_mode='line'):
+    '''Returns a unified diff of the two files as a generator.  In 'block' mode .tf
+    files are split into their top-level blocks and only the blocks that changed are
+    diffed, see hcl_blocks.  Lines are matched by the diff engine chosen with
+    --diff-engine, see diff_engines.'''
+    file1_lines = read_lines(file1_path)
+    file2_lines = read_lines(file2_path)
+
+    if diff_mode == 'block' and file1_path.endswith('.tf'):
+        return hcl_blocks.unified_block_diff(
+            file1_lines, file2_lines,
+            fromfile=file1_path, tofile=file2_path)
+    difflines = diff_engines.unified_diff(
         file1_lines, file2_lines,
-        fromfile=file1_path, tofile=file2_path, lineterm='')
+        fromfile=file1_path, tofile=file2_path)
     return difflines
 
 
+class FileDiff(object):
+    '''diff_files without the blank lines.  The diff is computed the first time it is
+    needed, then it can be iterated for its lines or counted.  In line mode counting
+    works from the diff engine's hunks without formatting any lines, and files with the
+    same lines are found to be empty without being aligned at all.  file1_sha256 and
+    file2_sha256 are the hashes of exactly the contents that were diffed.'''
+
+    def __init__(self, file1_path, file2_path, diff_mode='line'):
+        self.file1_path = file1_path
+        self.file2_path = file2_path
+        self.diff_mode = diff_mode
+        self.block_mode = diff_mode == 'block' and file1_path.endswith('.tf')
+        self.file1_lines = None
+        self.file2_lines = None
+        self.computed = False
+        self.groups = None
+        self.block_lines = None
+
+    def read(self):
+        if self.file1_lines is not None:
+            return
+        with timings.span('read file', 'file', file=self.file2_path):
+            self.file1_lines, self.file1_sha256 = read_lines_and_sha256(self.file1_path)
+            self.file2_lines, self.file2_sha256 = read_lines_and_sha256(self.file2_path)
+
+    def compute(self):
+        if self.computed:
+            return self
+        self.read()
+        with timings.span('diff file', 'file', file=self.file2_path) as span:
+            if self.file1_lines == self.file2_lines:
+                self.groups = []
+            elif self.block_mode:
+                self.block_lines = [line for line in hcl_blocks.unified_block_diff(
+                    self.file1_lines, self.file2_lines,
+                    fromfile=self.file1_path, tofile=self.file2_path) if line.strip() != '']
+            else:
+                self.groups = diff_engines.grouped_opcodes(self.file1_lines, self.file2_lines)
+            span.set(lines=len(self.file1_lines) + len(self.file2_lines))
+        self.computed = True
+        return self
+
+    def is_empty(self):
+        '''Only block diffs need computing to know, reordered blocks can make them
+        empty when the lines aren't the same.'''
+        self.read()
+        if self.file1_lines == self.file2_lines:
+            return True
+        if not self.block_mode:
+            return False
+        self.compute()
+        return not self.block_lines
+
+    def __iter__(self):
+        self.compute()
+        if self.block_lines is not None:
+            return iter(self.block_lines)
+        return (line for line in diff_engines.format_unified_diff(
+                    self.file1_lines, self.file2_lines, self.groups,
+                    self.file1_path, self.file2_path)
+                if line.strip() != '')
+
+    def count(self):
+        self.compute()
+        if self.block_lines is not None:
+            return len(self.block_lines)
+        return diff_engines.count_unified_diff(self.file1_lines, self.groups)
+
+
+def iter_difflines(file1_path, file2_path, diff_mode='line'):
+    '''diff_files without the blank lines, see FileDiff.'''
+    return FileDiff(file1_path, file2_path, diff_mode)
+
+
+def count_difflines(difflines):
+    '''Counts the lines of a diff without keeping them.'''
+    if isinstance(difflines, FileDiff):
+        return difflines.count()
+    return sum(1 for _ in difflines)
+
+
+def snapshot_sha256(snapshot, filename, fingerprints=None):
+    '''The sha256 of a file in a snapshot, known by the snapshot itself (archive
+    members), from the fingerprint cache or by reading the file.'''
+    sha256 = snapshot.sha256(filename)
+    if sha256:
+        return sha256
+    if fingerprints is not None:
+        return fingerprints.fingerprint(snapshot.path(filename), snapshot.stat(filename))
+    return hash_file(snapshot.path(filename))
+
+
 def envprefix_from_directory(directory):
     env_name = os.path.basename(os.path.normpath(directory))
     env_name = env_name.split('-')[0] # '/dev/', '/dev-us-east-1/' -> 'dev'
@@ -105,51 +327,257 @@ def envprefix_from_directory(directory):
     return prefix
     
 
-def compare_filecontents(filenames, from_directory, to_directory, use_env_prefix, ignore_missing):
+@timings.traced()
+def compare_filecontents(filenames, from_directory, to_directory, use_env_prefix, ignore_missing,
+                         stats=None, fingerprints=None, diff_mode='line', jobs=1):
+    '''Diffs each file between the from and to directories and returns a list of
+    (filename, difflines) for the files that differ, see iter_filecontents_diffs.'''
+    diffs = []
+    for filename, difflines in iter_filecontents_diffs(
+            filenames, from_directory, to_directory, use_env_prefix, ignore_missing,
+            stats=stats, fingerprints=fingerprints, diff_mode=diff_mode, jobs=jobs):
+        difflines_list = list(difflines)
+        logger.debug("{} lines different in {}".format(
+            len(difflines_list), filename))
+        diffs.append( (filename, difflines_list) )
+    return diffs
+
+
+def map_in_order(function, items, jobs):
+    '''Like ThreadPoolExecutor.map, but only keeps a bounded number of results waiting to
+    be consumed so memory doesn't grow with the number of items.'''
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_filecontents_diffs(filenames, from_directory, to_directory, use_env_prefix,
+                            ignore_missing, stats=None, fingerprints=None, diff_mode='line',
+                            jobs=1):
+    '''Diffs each file between the from and to directories, yielding (filename, difflines)
+    for each file that differs as soon as it has been compared.  difflines is a FileDiff
+    which formats its lines as they are consumed, so only one file is held in memory at
+    a time.  diff_mode is one of DIFF_MODES, see diff_files.  Byte identical files skip
+    the diff entirely, if a stats dict is given the number of files that took this fast path
+    ('identical') versus the full diff ('diffed') are added to it.  If a FingerprintCache
+    is given, identical files are detected from their cached fingerprints instead of
+    reading them, and files with git blob ids in both snapshots (see git_index) are
+    compared by those.  The directories may be paths or DirectorySnapshots, when snapshots are
+    given the stat results they hold are used rather than checking the files again.
+
+    With jobs > 1 files are read and diffed on that many threads.  Results are still
+    yielded in filename order and errors are raised when their file is reached, but up to
+    2 * jobs diffs are held in memory while waiting their turn.'''
+    from_snapshot = as_snapshot(from_directory)
+    to_snapshot = as_snapshot(to_directory)
+    if stats is None:
+        stats = {}
+    stats.setdefault('identical', 0)
+    stats.setdefault('diffed', 0)
+
     if use_env_prefix:
-        from_prefix = envprefix_from_directory(from_directory)
-        to_prefix = envprefix_from_directory(to_directory)
+        from_prefix = from_snapshot.env_prefix
+        to_prefix = to_snapshot.env_prefix
     else:
         from_prefix = ''
         to_prefix = ''
 
-    diffs = []
-    for filename in filenames:
-        from_filename = os.path.join(from_directory, from_prefix + filename)
-        to_filename = os.path.join(to_directory, to_prefix + filename)
+    def compare_file(filename):
+        '''Returns ('missing', path), ('identical', None) or ('diff', difflines).'''
+        from_name = add_prefix(from_prefix, filename)
+        to_name = add_prefix(to_prefix, filename)
+        for snapshot, name in [(from_snapshot, from_name), (to_snapshot, to_name)]:
+            if not snapshot.has(name):
+                return 'missing', snapshot.path(name)
+
+        from_stat = from_snapshot.stat(from_name)
+        to_stat = to_snapshot.stat(to_name)
+        file_bytes = from_stat.st_size + to_stat.st_size
+        from_blob_id = from_snapshot.blob_id(from_name)
+        to_blob_id = to_snapshot.blob_id(to_name)
+        # the from path is only asked for once it's needed, as that extracts archive members
+        to_filename = to_snapshot.path(to_name)
+        with timings.span('compare file', 'file', file=to_filename, bytes=file_bytes) as span:
+            if from_blob_id and to_blob_id:
+                # both match the git index, no need to open either of them
+                identical = from_blob_id == to_blob_id
+            elif from_stat.st_size != to_stat.st_size:
+                identical = False
+            elif from_snapshot.sha256(from_name) or to_snapshot.sha256(to_name):
+                # archive members are hashed as they are read from the archive
+                identical = snapshot_sha256(from_snapshot, from_name, fingerprints) == \
+                    snapshot_sha256(to_snapshot, to_name, fingerprints)
+            elif fingerprints is not None:
+                identical = fingerprints.fingerprint(from_snapshot.path(from_name), from_stat) == \
+                    fingerprints.fingerprint(to_filename, to_stat)
+            else:
+                identical = files_identical(
+                    from_snapshot.path(from_name), to_filename, check_size=False)
+            span.set(identical=identical)
+        if identical:
+            return 'identical', None
+
+        from_filename = from_snapshot.path(from_name)
         logger.debug("Diff on FROM filename: {}".format(from_filename))
         logger.debug("Diff on TO filename: {}".format(to_filename))
-        if not os.path.exists(from_filename) and ignore_missing:
-            print('Ignoring missing file: {}'.format(from_filename))
+
+        difflines = iter_difflines(from_filename, to_filename, diff_mode)
+        if jobs > 1:
+            # diff on the worker thread rather than lazily on the consumer's
+            difflines.compute()
+        return 'diff', difflines
+
+    if jobs > 1:
+        results = map_in_order(compare_file, filenames, jobs)
+    else:
+        results = (compare_file(filename) for filename in filenames)
+
+    for filename, (result, value) in zip(filenames, results):
+        if result == 'missing':
+            if not ignore_missing:
+                raise IOError("File not found: {}".format(value))
+            print('Ignoring missing file: {}'.format(value))
             continue
-        if not os.path.exists(to_filename) and ignore_missing:
-            print('Ignoring missing file: {}'.format(to_filename))
+        if result == 'identical':
+            logger.debug("{} is identical, skipping diff".format(filename))
+            stats['identical'] += 1
             continue
 
-        difflines = diff_files(from_filename, to_filename)
-        # difflines is a generator
-        difflines_list = list(filter(lambda a: a.strip() != '', difflines))
-        logger.debug("{} lines different in {}".format(
-            len(difflines_list), filename))
-        if len(difflines_list) > 0:
-            diffs.append( (filename, difflines_list) )
-    
-    return diffs  
+        stats['diffed'] += 1
+        # only yield files with at least one line different
+        if value.is_empty():
+            continue
+        yield filename, value
 
 
-def promote_files(filenames, from_path, to_path, continue_on_error = False):
+@timings.traced()
+def analyze_promotion(from_path, to_path, ignore_missing=False, fingerprints=None,
+                      diff_mode='line', jobs=1):
+    '''Scans and diffs a from/to environment directory pair without prompting or
+    copying anything, and returns a dict describing what promoting it would do.  If
+    files are missing and ignore_missing isn't set the pair is marked as blocked and
+    file contents are not compared.  The paths may also be snapshots.  fingerprints is
+    an optional FingerprintCache, jobs is the number of threads used to compare files.
+
+    env_diffs and diffs are lazy generators of (filename, difflines) that compare the
+    files as they are consumed, so they can only be iterated once.  Use
+    count_promotion_diffs to replace them with line counts that can be kept around.'''
+    from_snapshot = as_snapshot(from_path)
+    to_snapshot = as_snapshot(to_path)
+    from_path = from_snapshot.directory
+    to_path = to_snapshot.directory
+    from_env = from_snapshot.env_name
+    to_env = to_snapshot.env_name
+
+    new_files, missing_files = validate_filenames(
+        from_snapshot.nonenv_files, to_snapshot.nonenv_files)
+    new_env_files, missing_env_files = validate_filenames(
+        from_snapshot.env_files, to_snapshot.env_files)
+
+    promotion = {
+        'from_path': from_path,
+        'from_env': from_env,
+        'to_path': to_path,
+        'to_env': to_env,
+        'from_snapshot': from_snapshot,
+        'to_snapshot': to_snapshot,
+        'new_files': new_files,
+        'missing_files': missing_files,
+        # env files are reported with their environment prefixes
+        'new_env_files': [add_prefix(from_snapshot.env_prefix, f) for f in new_env_files],
+        'missing_env_files': [add_prefix(to_snapshot.env_prefix, f) for f in missing_env_files],
+        'blocked': False,
+        'env_diffs': [],
+        'diffs': [],
+        'compare_stats': {'identical': 0, 'diffed': 0},
+        'diff_mode': diff_mode
+    }
+    if (missing_files or new_env_files or missing_env_files) and not ignore_missing:
+        promotion['blocked'] = True
+        return promotion
+
+    # just for comparing, these are expected to be different per environment
+    promotion['env_diffs'] = iter_filecontents_diffs(
+        sorted(from_snapshot.env_set & to_snapshot.env_set),
+        from_snapshot, to_snapshot,
+        use_env_prefix=True,
+        ignore_missing=ignore_missing,
+        stats=promotion['compare_stats'],
+        fingerprints=fingerprints,
+        diff_mode=diff_mode,
+        jobs=jobs)
+    # new files have nothing to diff against, they are promoted as is
+    promotion['diffs'] = iter_filecontents_diffs(
+        sorted(from_snapshot.nonenv_set & to_snapshot.nonenv_set),
+        from_snapshot, to_snapshot,
+        use_env_prefix=False,
+        ignore_missing=ignore_missing,
+        stats=promotion['compare_stats'],
+        fingerprints=fingerprints,
+        diff_mode=diff_mode,
+        jobs=jobs)
+    return promotion
+
+
+@timings.traced()
+def count_promotion_diffs(promotion):
+    '''Consumes the lazy diffs of an analyzed promotion, replacing them with lists of
+    (filename, number of lines different).  The (from, to) sha256 of the contents each
+    modified file was diffed with are kept in diff_sha256s, for plan.'''
+    promotion['diff_sha256s'] = {}
+    for key in ('env_diffs', 'diffs'):
+        counted = []
+        for filename, difflines in promotion[key]:
+            counted.append((filename, count_difflines(difflines)))
+            if key == 'diffs' and isinstance(difflines, FileDiff):
+                promotion['diff_sha256s'][filename] = \
+                    (difflines.file1_sha256, difflines.file2_sha256)
+        promotion[key] = counted
+    return promotion
+
+
+@timings.traced()
+def stage_files(transaction, filenames, from_path, to_path, continue_on_error = False,
+                sha256s=None):
+    '''Stages files from from_path to be promoted into to_path by a PromotionTransaction.
+    from_path may also be a snapshot, e.g. an archive.ArchiveSnapshot which extracts the
+    files as they are staged.  sha256s optionally maps filenames to the sha256 their
+    contents must have, see PromotionTransaction.stage.  With continue_on_error files
+    which fail to stage are skipped.'''
     for filename in filenames:
         try:
             print("Promoting {}".format(filename))
-            shutil.copyfile(
-                os.path.join(from_path, filename),
-                os.path.join(to_path, filename)
+            if isinstance(from_path, str):
+                source_path = os.path.join(from_path, filename)
+            else:
+                source_path = from_path.path(filename)
+            transaction.stage(
+                source_path,
+                os.path.join(to_path, filename),
+                sha256=(sha256s or {}).get(filename)
             )
         except Exception as e:
             print("Error promoting {}: {}".format(filename, e))
             if not continue_on_error:
                 raise
 
+
+@timings.traced()
+def promote_files(filenames, from_path, to_path, continue_on_error = False):
+    '''Copies the files from from_path to to_path all or nothing, see
+    PromotionTransaction.  If promoting fails part way through, to_path is left as it
+    was.'''
+    with PromotionTransaction() as transaction:
+        stage_files(transaction, filenames, from_path, to_path, continue_on_error)
+        transaction.commit()
+    print(transaction.summary())
+    return transaction
+
 def find_executable(executable):
     '''Similar to bash "which". Returns full path or None if no
     command is found.'''
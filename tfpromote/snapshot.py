@@ -0,0 +1,232 @@
+import os
+import atexit
+import shutil
+import fnmatch
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import timings
+
+logger = logging.getLogger(__name__)
+
+# files a snapshot holds unless --include is given
+DEFAULT_INCLUDE = ['*.tf']
+DEFAULT_RECURSIVE_INCLUDE = ['*.tf', '*.tfvars', '*.tpl', '*.json']
+# never promoted by a recursive snapshot, on top of any --exclude.  Hidden directories
+# cover .terraform, with its provider binaries and module copies, .git and the
+# staging directories of an unfinished promotion
+DEFAULT_RECURSIVE_EXCLUDE = ['.*', 'terraform.tfstate.d', '*.tfstate', '*.tfstate.backup']
+# threads scanning the subdirectories of a recursive snapshot when --jobs isn't given
+DEFAULT_SCAN_JOBS = 8
+# the temporary directories archive and git revision snapshots write their files to
+temp_directories = []
+
+
+def make_temp_directory(prefix):
+    '''A temporary directory for a snapshot's files, removed at exit or, in the daemon,
+    once the command that made it is finished.'''
+    directory = tempfile.mkdtemp(prefix=prefix)
+    temp_directories.append(directory)
+    return directory
+
+
+def remove_temp_directories():
+    while temp_directories:
+        shutil.rmtree(temp_directories.pop(), True)
+
+
+atexit.register(remove_temp_directories)
+
+
+def add_prefix(prefix, filename):
+    '''Env prefixes go on the file's own name, e.g. modules/variables.tf ->
+    modules/dev-variables.tf.'''
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, prefix + name)
+
+
+def split_env_files(filenames, env_prefix):
+    '''Returns the sorted (non-env filenames, env filenames with the prefix removed),
+    the prefix being looked for on the file's own name at every level.'''
+    nonenv_files = []
+    env_files = []
+    for filename in filenames:
+        directory, name = os.path.split(filename)
+        if name.startswith(env_prefix):
+            env_files.append(os.path.join(directory, name[len(env_prefix):]))
+        else:
+            nonenv_files.append(filename)
+    return sorted(nonenv_files), sorted(env_files)
+
+
+def matches(relative_path, patterns):
+    '''True if the file's name or its path relative to the snapshot directory (with /
+    separators) matches one of the glob patterns.'''
+    name = os.path.basename(relative_path)
+    relative_path = relative_path.replace(os.sep, '/')
+    return any(fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(relative_path, pattern)
+               for pattern in patterns)
+
+
+class FileFilter(object):
+    '''Which files and subdirectories of an environment directory a snapshot holds.
+    Explicit include patterns replace the defaults, exclude patterns are added to them.'''
+
+    def __init__(self, recursive=False, include=None, exclude=None):
+        self.recursive = recursive
+        if include:
+            self.include = list(include)
+        elif recursive:
+            self.include = DEFAULT_RECURSIVE_INCLUDE
+        else:
+            self.include = DEFAULT_INCLUDE
+        self.exclude = list(exclude or [])
+        if recursive:
+            self.exclude += DEFAULT_RECURSIVE_EXCLUDE
+
+    def includes(self, relative_path):
+        return matches(relative_path, self.include) and not matches(relative_path, self.exclude)
+
+    def descends(self, relative_dir):
+        return self.recursive and not matches(relative_dir, self.exclude)
+
+    def wants(self, relative_path):
+        '''includes() for a path found without walking, e.g. in a git tree, so none of its
+        directories have been checked.'''
+        directory = os.path.dirname(relative_path)
+        while directory:
+            if not self.descends(directory):
+                return False
+            directory = os.path.dirname(directory)
+        return self.includes(relative_path)
+
+
+def scan_tree(directory, file_filter, jobs=1):
+    '''Returns {relative path: os.stat_result} of the files in directory the filter
+    includes.  Each directory is read with a single os.scandir pass and excluded
+    subdirectories are never entered.  With jobs > 1 subdirectories are scanned on a
+    thread pool as they are found, which helps wide trees and network filesystems.'''
+    def scan(relative_dir):
+        files = []
+        subdirs = []
+        with os.scandir(os.path.join(directory, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name)
+                # symlinked directories aren't followed, they could loop
+                if file_filter.recursive and entry.is_dir(follow_symlinks=False):
+                    if file_filter.descends(relative_path):
+                        subdirs.append(relative_path)
+                elif file_filter.includes(relative_path) and entry.is_file():
+                    files.append((relative_path, entry.stat()))
+        return files, subdirs
+
+    stats = {}
+    if jobs <= 1:
+        pending = ['']
+        while pending:
+            files, subdirs = scan(pending.pop())
+            stats.update(files)
+            pending.extend(subdirs)
+        return stats
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(scan, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                stats.update(files)
+                pending.update(executor.submit(scan, subdir) for subdir in subdirs)
+    return stats
+
+
+class DirectorySnapshot(object):
+    '''The .tf files in an environment directory, read with a single os.scandir pass.
+    Holds the env/non-env split of the filenames along with the stat result of every
+    file so later phases don't need to go back to the filesystem.  Key assumption - that
+    the last folder in the directory structure is also the name of the environment.
+
+    With recursive, files in subdirectories such as modules/ are included too, named by
+    their path relative to directory, see FileFilter and scan_tree.'''
+
+    def __init__(self, directory, recursive=False, include=None, exclude=None, jobs=None):
+        self.directory = directory
+        self.env_name = os.path.basename(os.path.normpath(directory))
+        self.env_name = self.env_name.split('-')[0] # '/dev/', '/dev-us-east-1/' -> 'dev'
+        self.env_prefix = "{}-".format(self.env_name)
+        self.file_filter = FileFilter(recursive, include, exclude)
+        # actual filename -> git blob id of files known to match it, see git_index
+        self.blob_ids = {}
+
+        if jobs is None:
+            jobs = DEFAULT_SCAN_JOBS if recursive else 1
+        with timings.span('scan directory', 'file', directory=directory):
+            # actual filename -> os.stat_result
+            self.stats = scan_tree(directory, self.file_filter, jobs)
+        # filenames without an env prefix, e.g. iam.tf, and filenames with the env prefix
+        # removed, e.g. dev-variables.tf -> variables.tf
+        self.nonenv_files, self.env_files = split_env_files(self.stats, self.env_prefix)
+        self.nonenv_set = set(self.nonenv_files)
+        self.env_set = set(self.env_files)
+        logger.info("Found {} non-env and {} env files in {}".format(
+            len(self.nonenv_files), len(self.env_files), directory))
+
+    def has(self, filename):
+        '''filename is the actual name on disk, including any env prefix.'''
+        return filename in self.stats
+
+    def stat(self, filename):
+        return self.stats[filename]
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def blob_id(self, filename):
+        return self.blob_ids.get(filename)
+
+    def sha256(self, filename):
+        '''The file's sha256 if it is known without reading the file, see
+        archive.ArchiveSnapshot.'''
+        return None
+
+
+class PromotedSnapshot(object):
+    '''What a snapshot will look like once files have been promoted into it, without
+    copying anything.  promoted maps each promoted filename to the snapshot it is
+    promoted from, the stats and paths of those files come from there.'''
+
+    def __init__(self, snapshot, promoted):
+        self.snapshot = snapshot
+        self.promoted = promoted
+        self.directory = snapshot.directory
+        self.env_name = snapshot.env_name
+        self.env_prefix = snapshot.env_prefix
+        self.nonenv_files = sorted(set(snapshot.nonenv_files) | set(promoted))
+        self.env_files = snapshot.env_files
+        self.nonenv_set = set(self.nonenv_files)
+        self.env_set = snapshot.env_set
+
+    def source(self, filename):
+        return self.promoted.get(filename, self.snapshot)
+
+    def has(self, filename):
+        return self.source(filename).has(filename)
+
+    def stat(self, filename):
+        return self.source(filename).stat(filename)
+
+    def path(self, filename):
+        return self.source(filename).path(filename)
+
+    def blob_id(self, filename):
+        return self.source(filename).blob_id(filename)
+
+    def sha256(self, filename):
+        return self.source(filename).sha256(filename)
+
+
+def as_snapshot(directory):
+    '''Accepts either a directory path or a snapshot, e.g. a DirectorySnapshot,
+    git_index.GitRevisionSnapshot or archive.ArchiveSnapshot.'''
+    if isinstance(directory, str):
+        return DirectorySnapshot(directory)
+    return directory
@@ -3,22 +3,122 @@
 from __future__ import print_function
 import os
 import sys
+import atexit
+import logging
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from . import promote_tool
+from .fingerprint_cache import FingerprintCache, open_cache
+from .transaction import PromotionTransaction
+from .snapshot import DirectorySnapshot, PromotedSnapshot, add_prefix
+from . import plan as promotion_plan
+from . import timings
+from . import git_index
+from . import archive
+from . import diff_engines
+from .difftool import run_difftool, run_dir_diff, get_executable as get_difftool_executable
+from .version import __version__
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got {}".format(value))
+    return number
+
+
+# (option, args attribute) of the options which choose what tfpromote does
+MODE_OPTIONS = [
+    ('--status', 'status'),
+    ('--apply', 'apply_path'),
+    ('--batch', 'batch_root'),
+    ('--chain', 'chain'),
+    ('--fan-out', 'fan_out_env'),
+    ('--watch', 'watch'),
+    ('--plan', 'plan_path'),
+]
+# the only modes which can be used together
+COMBINABLE_MODES = [
+    ('--status', '--batch'),
+    ('--batch', '--plan'),
+    ('--fan-out', '--plan'),
+]
+
+
+def get_conflicting_modes(args):
+    '''The first two options given which choose different things to do, or None.'''
+    modes = [option for option, dest in MODE_OPTIONS if getattr(args, dest)]
+    for i, mode in enumerate(modes):
+        for other_mode in modes[i + 1:]:
+            if (mode, other_mode) not in COMBINABLE_MODES:
+                return mode, other_mode
+    return None
 
 
 def create_parser():
     parser = argparse.ArgumentParser(add_help=False) # since we are specifically handing --help
     parser.add_argument('--help', action='store_true', required=False)
-    parser.add_argument('--from', dest='from_path', required=False)
+    parser.add_argument('--from', dest='from_path', required=False,
+        help='Directory to promote from, or a .tar.gz, .tgz, .tar.bz2, .tar.xz, .tar or .zip archive of one named for its environment, e.g. dev-1.4.tar.gz')
     parser.add_argument('--to', dest='to_path', required=False)
     parser.add_argument('--auto-approve', action='store_true', default=False)
     parser.add_argument('--ignore-missing', action='store_true', default=False)
     parser.add_argument('-a', '--auto', dest='auto_paths', action='store_true', default=False,
         help='Assumes current path is to path and from path is the lesser environment in TFPROMOTE_ENVS')
+    parser.add_argument('--batch', dest='batch_root', required=False,
+        help='Promote every environment directory named by --env found under this root directory')
+    parser.add_argument('--env', dest='batch_env', required=False,
+        help='Environment to promote into in --batch mode, e.g. stage')
+    parser.add_argument('--jobs', type=positive_int, default=None,
+        help='Number of worker threads used to compare files, or directories in --batch mode')
+    parser.add_argument('--block-diff', dest='diff_mode', action='store_const',
+        const='block', default='line',
+        help='Diff .tf files per top-level block (resource, module, ...), ignoring reordered blocks')
+    parser.add_argument('--diff-engine', choices=sorted(diff_engines.DIFF_ENGINES), required=False,
+        help='How lines are matched up in diffs, default TFPROMOTE_DIFF_ENGINE or histogram')
+    parser.add_argument('--chain', nargs=2, metavar=('FROM_ENV', 'TO_ENV'), required=False,
+        help='Promote through every environment from FROM_ENV to TO_ENV, e.g. --chain dev prod')
+    parser.add_argument('--fan-out', dest='fan_out_env', required=False,
+        help='Promote the --from (or current) directory into every regional directory of this environment next to it')
+    parser.add_argument('--status', action='store_true', default=False,
+        help='Show which environments have which version of each file instead of promoting, with --batch for every service under a root')
+    parser.add_argument('--watch', action='store_true', default=False,
+        help='Keep showing what would be promoted, updating as files change, instead of promoting')
+    parser.add_argument('--plan', dest='plan_path', required=False,
+        help='Write what would be promoted to this JSON plan file instead of promoting')
+    parser.add_argument('--apply', dest='apply_path', required=False,
+        help='Promote the files listed in a plan file written by --plan, if none of them changed since')
+    parser.add_argument('--dir-diff', action='store_true', default=False,
+        help='Launch the difftool once to compare two directories holding just the files which differ, instead of once per file')
+    parser.add_argument('--git', action='store_true', default=False,
+        help='Treat files whose git blob ids match in the git index as identical without reading them')
+    parser.add_argument('--rev', dest='from_rev', required=False,
+        help='Promote the --from (or lower environment) directory as of this git commit, branch or tag instead of its working copy')
+    parser.add_argument('--recursive', action='store_true', default=False,
+        help='Also promote files in subdirectories such as modules/, skipping .terraform and other hidden directories')
+    parser.add_argument('--include', action='append', metavar='GLOB', required=False,
+        help='Only promote files whose name or relative path matches, may be repeated, default *.tf (with --recursive also *.tfvars, *.tpl and *.json)')
+    parser.add_argument('--exclude', action='append', metavar='GLOB', required=False,
+        help='Skip files and directories whose name or relative path matches, may be repeated')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+        help='Do not use the file fingerprint cache (TFPROMOTE_CACHE_DIR, default ~/.cache/tfpromote)')
+    parser.add_argument('--rebuild-cache', action='store_true', default=False,
+        help='Discard the file fingerprint cache and fingerprint every file again')
+    parser.add_argument('--timings', action='store_true', default=False,
+        help='Print how long each phase took and write a trace file, also enabled by TFPROMOTE_TIMINGS=1')
+    parser.add_argument('--trace-file', dest='trace_path', required=False,
+        help='Where --timings writes its Chrome trace-event JSON, default TFPROMOTE_TRACE_FILE or a temp file')
+    parser.add_argument('--profile', dest='profile_path', required=False,
+        help='Also run cProfile and write its stats to this file, implies --timings')
+    parser.add_argument('--daemon', action='store_true', default=False,
+        help='Keep running and run the commands of other tfpromote invocations, with warm caches (socket: TFPROMOTE_SOCKET)')
+    parser.add_argument('--no-daemon', action='store_true', default=False,
+        help='Run in this process even if a tfpromote daemon is listening')
 
     mutually_exclusive_group = parser.add_mutually_exclusive_group(required=False)
-    mutually_exclusive_group.add_argument('--difftool', required=False)
+    mutually_exclusive_group.add_argument('--difftool', required=False,
+        help='Command to compare two files, e.g. meld or "code --diff {from} {to}", default TFPROMOTE_DIFFTOOL')
     mutually_exclusive_group.add_argument('--printdiff', action='store_true')
 
     return parser
@@ -58,6 +158,8 @@ def get_to_from_environments(args):
     # assumes the last folder in the directory structure is the name of the environment
     from_env = os.path.basename(os.path.normpath(from_path))
     from_env = from_env.split('-')[0] # '/dev/' or 'dev-us-east-1' -> 'dev'
+    if archive.is_archive(from_path):
+        from_env = archive.archive_env_name(from_path) # 'dev-1.4.tar.gz' -> 'dev'
     to_env   = os.path.basename(os.path.normpath(to_path))
     to_env = to_env.split('-')[0] # '/dev/' or 'dev-us-east-1' -> 'dev'
 
@@ -85,16 +187,428 @@ def get_to_from_environments(args):
     }
 
 
-def main():
-    here = os.path.abspath(os.path.dirname(__file__))
-    about = {}
-    with open(os.path.join(here, 'version.py'), 'r') as f:
-        exec(f.read(), about)
+def print_promotion_summary(promotion, root_path, printdiff):
+    '''Prints one line per directory pair (plus diffs if asked) for --batch mode.
+    Returns True if this pair blocks the batch from being promoted.'''
+    label = "{} -> {}".format(
+        os.path.relpath(promotion['from_path'], root_path),
+        os.path.relpath(promotion['to_path'], root_path))
+    if 'error' in promotion:
+        print("{}: ERROR {}".format(label, promotion['error']))
+        return True
+    if promotion['blocked']:
+        print("{}: BLOCKED".format(label))
+        for key, has_env, lacks_env in [
+                ('missing_files', 'to_env', 'from_env'),
+                ('missing_env_files', 'to_env', 'from_env'),
+                ('new_env_files', 'from_env', 'to_env')]:
+            if promotion[key]:
+                print("    Files present in {} not found in {}: {}".format(
+                    promotion[has_env], promotion[lacks_env], promotion[key]))
+        return True
+    if not promotion['new_files'] and not promotion['diffs']:
+        print("{}: nothing to promote".format(label))
+        return False
+    print("{}: {} new, {} modified".format(
+        label, len(promotion['new_files']), len(promotion['diffs'])))
+    for filename in promotion['new_files']:
+        print("    New: {}".format(filename))
+    for filename, line_count in promotion['diffs']:
+        print("    Diff: {} - {} lines different".format(filename, line_count))
+        if printdiff:
+            # the diffs weren't kept, stream them again one file at a time
+            for line in promote_tool.iter_difflines(
+                    promotion['from_snapshot'].path(filename),
+                    promotion['to_snapshot'].path(filename),
+                    promotion['diff_mode']):
+                print(line)
+    return False
+
+
+def start_timings(args):
+    '''Starts recording spans if --timings, --trace-file, --profile or TFPROMOTE_TIMINGS
+    is given, the summary and trace are written when tfpromote exits.'''
+    if not (args.timings or args.trace_path or args.profile_path or
+            os.environ.get('TFPROMOTE_TIMINGS')):
+        return
+    trace_path = args.trace_path or os.environ.get('TFPROMOTE_TRACE_FILE') or \
+        os.path.join(tempfile.gettempdir(), 'tfpromote-trace-{}.json'.format(os.getpid()))
+    timings.enable(trace_path, args.profile_path)
+    atexit.register(timings.finish)
+
+
+def read_response():
+    '''Reads the answer to a prompt, in its own span so time spent waiting on the user
+    isn't mistaken for work.'''
+    with timings.span('waiting for input', 'wait'):
+        return sys.stdin.readline()
+
+
+def snapshot_options(args):
+    '''The DirectorySnapshot options given by --recursive, --include and --exclude.'''
+    return {
+        'recursive': args.recursive,
+        'include': args.include,
+        'exclude': args.exclude
+    }
+
+
+def take_snapshot(args, path):
+    '''A DirectorySnapshot of path with the command line's options, path may already be a
+    snapshot.'''
+    if not isinstance(path, str):
+        return path
+    return DirectorySnapshot(path, jobs=args.jobs, **snapshot_options(args))
+
+
+def open_fingerprint_cache(args):
+    if args.no_cache:
+        return None
+    return open_cache(rebuild=args.rebuild_cache)
+
 
-    print('TFPromote version {}'.format(about['__version__']))
+def print_compare_stats(stats):
+    print("Compared {} files: {} identical (fast path), {} diffed".format(
+        stats['identical'] + stats['diffed'], stats['identical'], stats['diffed']))
+
+
+def run_plan(args, promotions, fingerprints, version, print_summary=True):
+    '''Writes the --plan file for analyzed promotions (with counted diffs).'''
+    blocked = False
+    for promotion in promotions:
+        if print_summary and print_promotion_summary(promotion, os.getcwd(), printdiff=False):
+            blocked = True
+    if blocked:
+        print('Resolve the errors and missing files above before tfpromote will proceed or use --ignore-missing.')
+        sys.exit(1)
+    entries = [promotion_plan.plan_promotion(promotion, fingerprints) for promotion in promotions]
+    if fingerprints:
+        fingerprints.save()
+    promotion_plan.write_plan(args.plan_path, entries, version)
+    print("Wrote plan for {} new and {} modified files to {}".format(
+        sum(len(entry['new_files']) for entry in entries),
+        sum(len(entry['modified_files']) for entry in entries),
+        args.plan_path))
+
+
+def run_apply(args):
+    '''Promotes the files in the --apply plan file, refusing if any of them changed since
+    the plan was written.'''
+    try:
+        plan = promotion_plan.load_plan(args.apply_path)
+    except Exception as e:
+        print("Could not read plan {}: {}".format(args.apply_path, e))
+        sys.exit(1)
+    fingerprints = open_fingerprint_cache(args)
+    drifted = promotion_plan.check_plan(plan, fingerprints)
+    if fingerprints:
+        fingerprints.save()
+    if drifted:
+        print("Files changed since the plan was written, refusing to apply {}:".format(
+            args.apply_path))
+        for message in drifted:
+            print("    {}".format(message))
+        sys.exit(1)
+    if not any(entry['new_files'] or entry['modified_files'] for entry in plan['promotions']):
+        print('Nothing to promote in {}'.format(args.apply_path))
+        sys.exit(0)
+    try:
+        promotion_plan.apply_plan(plan)
+    except Exception as e:
+        print("Nothing was promoted from {}: {}".format(args.apply_path, e))
+        sys.exit(1)
+
+
+def run_chain(args, difftool):
+    '''Promotes across several environments at once, e.g. dev -> stage -> prod.  Each
+    hop is compared against what the lower environment will contain once the previous
+    hop is promoted, every directory is scanned once and file fingerprints are shared
+    between hops.  Everything is promoted in one transaction after a single approval.'''
+    if difftool and not args.printdiff:
+        print('WARNING: --difftool is not used in --chain mode, use --printdiff to see the diffs.')
+    elif args.dir_diff and not args.printdiff:
+        print('WARNING: --dir-diff is not used in --chain mode, use --printdiff to see the diffs.')
+    try:
+        env_names = promote_tool.get_environment_chain(args.chain[0], args.chain[1])
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    # like auto paths mode, run from one of the environment directories or their parent
+    base_path = os.getcwd()
+    if promote_tool.is_env_path_valid(os.path.basename(base_path)):
+        base_path = os.path.dirname(base_path)
+    paths = [os.path.join(base_path, env_name) for env_name in env_names]
+    for path in paths:
+        if not os.path.isdir(path):
+            print("Path does not exist: {}".format(path))
+            sys.exit(1)
+    print("Promoting {} in {}".format(' -> '.join(env_names), base_path))
+
+    # fingerprints are shared between hops even when the on disk cache isn't used
+    fingerprints = open_fingerprint_cache(args) or FingerprintCache(rebuild=True)
+
+    def scan(path):
+        snapshot = take_snapshot(args, path)
+        if args.git:
+            snapshot = git_index.load_blob_ids(snapshot)
+        return snapshot
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        snapshots = list(executor.map(scan, paths))
+    from_snapshot = snapshots[0]
+    promotions = []
+    for to_snapshot in snapshots[1:]:
+        promotion = promote_tool.count_promotion_diffs(promote_tool.analyze_promotion(
+            from_snapshot, to_snapshot, ignore_missing=args.ignore_missing,
+            fingerprints=fingerprints, diff_mode=args.diff_mode, jobs=args.jobs or 1))
+        promotions.append(promotion)
+        if promotion['blocked']:
+            break
+        # the next hop is compared with this environment as it will be once promoted
+        promoted = dict((filename, from_snapshot) for filename in
+                        promotion['new_files'] + [filename for filename, _ in promotion['diffs']])
+        from_snapshot = PromotedSnapshot(to_snapshot, promoted)
+    if not args.no_cache:
+        fingerprints.save()
+
+    print('')
+    blocked = False
+    for promotion in promotions:
+        if print_promotion_summary(promotion, base_path, args.printdiff):
+            blocked = True
+    if blocked:
+        print('Resolve the missing files above before tfpromote will proceed or use --ignore-missing.')
+        sys.exit(1)
+
+    to_promote = [p for p in promotions if p['new_files'] or p['diffs']]
+    if not to_promote:
+        print('No non-environment specific differences, nothing to promote!')
+        sys.exit(0)
+    print("\nTotal: {} new and {} modified files in {} environments.".format(
+        sum(len(p['new_files']) for p in to_promote),
+        sum(len(p['diffs']) for p in to_promote),
+        len(to_promote)))
+    proceed = False
+    if args.auto_approve:
+        proceed = True
+    else:
+        print("Promote new and modified files (N/y)?")
+        response = read_response()
+        if response[0] == 'y':
+            proceed = True
+    if not proceed:
+        sys.exit(1)
+    with PromotionTransaction() as transaction:
+        for promotion in to_promote:
+            print("Promoting into {}".format(promotion['to_env']))
+            for filename in promotion['new_files'] + [filename for filename, _ in promotion['diffs']]:
+                print("Promoting {}".format(filename))
+                # staged from where the content originates, not the intermediate env
+                transaction.stage(
+                    promotion['from_snapshot'].path(filename),
+                    os.path.join(promotion['to_path'], filename))
+        transaction.commit()
+    print(transaction.summary())
+
+
+def print_status(base_path, env_names, status):
+    '''Prints a file x environment matrix of the files which aren't the same everywhere.
+    Environments sharing a letter have identical copies of the file, A being the version
+    in the first environment which has it.'''
+    drifted = [filename for filename in sorted(status)
+               if len(set(status[filename])) > 1]
+    print("{}: {} of {} files differ between environments".format(
+        base_path, len(drifted), len(status)))
+    if not drifted:
+        return
+    rows = [['file'] + env_names]
+    for filename in drifted:
+        versions = {}
+        row = [filename]
+        for fingerprint in status[filename]:
+            if fingerprint is None:
+                row.append('-')
+                continue
+            if fingerprint not in versions:
+                versions[fingerprint] = chr(ord('A') + len(versions) % 26)
+            row.append(versions[fingerprint])
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('    ' + '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def run_status(args):
+    '''Shows which environments have which version of each non-env file, for the current
+    terraform directory or every one under the --batch root.'''
+    if args.batch_root:
+        base_paths = promote_tool.find_environment_base_directories(
+            os.path.abspath(args.batch_root))
+    else:
+        base_path = os.getcwd()
+        if promote_tool.is_env_path_valid(os.path.basename(base_path)):
+            base_path = os.path.dirname(base_path)
+        base_paths = [base_path]
+
+    fingerprints = open_fingerprint_cache(args)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        statuses = list(executor.map(
+            lambda base_path: promote_tool.environment_status(
+                base_path, fingerprints, snapshot_options(args)),
+            base_paths))
+    if fingerprints:
+        fingerprints.save()
+
+    if not base_paths:
+        print("No environment directories found under {}".format(args.batch_root))
+        return
+    print("Environments sharing a letter have the same version of a file, - is missing.")
+    for base_path, (env_names, status) in zip(base_paths, statuses):
+        print_status(base_path, env_names, status)
+
+
+def run_batch(args, difftool, version):
+    '''Scans and diffs every environment directory pair under the --batch root on a
+    worker pool, prints one combined summary and promotes the whole set after a single
+    approval.'''
+    root_path = os.path.abspath(args.batch_root)
+    if not args.batch_env:
+        print('--batch requires --env to name the environment to promote into, e.g. --env stage')
+        sys.exit(1)
+    if difftool and not args.printdiff:
+        print('WARNING: --difftool is not used in --batch mode, use --printdiff to see the diffs.')
+
+    try:
+        pairs = promote_tool.find_env_directory_pairs(root_path, args.batch_env)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    if not pairs:
+        print("No {} directories with a lower environment found under {}".format(
+            args.batch_env, root_path))
+        sys.exit(0)
+    print("Found {} {} directories to promote under {}".format(
+        len(pairs), args.batch_env, root_path))
+
+    fingerprints = open_fingerprint_cache(args)
+    promotions = analyze_pairs(args, pairs, fingerprints)
+    if fingerprints:
+        fingerprints.save()
+    review_and_promote(args, promotions, root_path, fingerprints, version)
+
+
+def analyze_pairs(args, pairs, fingerprints):
+    '''Analyzes (from, to) directory pairs on a worker pool, keeping only line counts of
+    their diffs.  Errors are kept in the promotion to be reported with the rest.'''
+    def analyze(pair):
+        from_side, to_side = pair
+        try:
+            from_snapshot = take_snapshot(args, from_side)
+            to_snapshot = take_snapshot(args, to_side)
+            if args.git:
+                from_snapshot = git_index.load_blob_ids(from_snapshot)
+                to_snapshot = git_index.load_blob_ids(to_snapshot)
+            return promote_tool.count_promotion_diffs(promote_tool.analyze_promotion(
+                from_snapshot, to_snapshot, ignore_missing=args.ignore_missing,
+                fingerprints=fingerprints, diff_mode=args.diff_mode))
+        except Exception as e:
+            # the from side may be a snapshot shared between pairs
+            return {'from_path': getattr(from_side, 'directory', from_side),
+                    'to_path': getattr(to_side, 'directory', to_side),
+                    'error': e}
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        return list(executor.map(analyze, pairs))
+
+
+def review_and_promote(args, promotions, root_path, fingerprints, version):
+    '''Prints one combined summary of several analyzed promotions, then writes the
+    --plan or asks once to promote all of them in a single transaction.'''
+    print('')
+    blocked = False
+    for promotion in promotions:
+        if print_promotion_summary(promotion, root_path, args.printdiff):
+            blocked = True
+    if not blocked:
+        print_compare_stats({
+            'identical': sum(p['compare_stats']['identical'] for p in promotions),
+            'diffed': sum(p['compare_stats']['diffed'] for p in promotions)
+        })
+    if blocked:
+        print('Resolve the errors and missing files above before tfpromote will proceed or use --ignore-missing.')
+        sys.exit(1)
+
+    if args.plan_path:
+        run_plan(args, promotions, fingerprints, version, print_summary=False)
+        return
+
+    to_promote = [p for p in promotions if p['new_files'] or p['diffs']]
+    new_count = sum(len(p['new_files']) for p in to_promote)
+    modified_count = sum(len(p['diffs']) for p in to_promote)
+    if not to_promote:
+        print('No non-environment specific differences, nothing to promote!')
+        sys.exit(0)
+
+    print("\nTotal: {} new and {} modified files in {} directories.".format(
+        new_count, modified_count, len(to_promote)))
+    proceed = False
+    if args.auto_approve:
+        proceed = True
+    else:
+        print("Promote new and modified files (N/y)?")
+        response = read_response()
+        if response[0] == 'y':
+            proceed = True
+    if not proceed:
+        sys.exit(1)
+    # one transaction for everything, nothing is promoted unless everything is
+    with PromotionTransaction() as transaction:
+        for promotion in to_promote:
+            print("Promoting into {}".format(os.path.relpath(promotion['to_path'], root_path)))
+            filenames = promotion['new_files'] + [filename for filename, _ in promotion['diffs']]
+            promote_tool.stage_files(
+                transaction, filenames, promotion['from_path'], promotion['to_path'])
+        transaction.commit()
+    print(transaction.summary())
+
+
+def run_fan_out(args, difftool, version):
+    '''Promotes one source environment directory into every regional directory of the
+    --fan-out environment next to it, e.g. dev into stage-us-east-1 and stage-eu-west-1.
+    The source is scanned and fingerprinted once and diffed against all of the targets
+    concurrently, followed by one combined summary and approval.'''
+    if difftool and not args.printdiff:
+        print('WARNING: --difftool is not used in --fan-out mode, use --printdiff to see the diffs.')
+    from_path = os.path.abspath(args.from_path) if args.from_path else os.getcwd()
+    base_path = os.path.dirname(os.path.normpath(from_path))
+    try:
+        to_paths = promote_tool.find_regional_directories(base_path, args.fan_out_env)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    if not to_paths:
+        print("No {} directories found next to {}".format(args.fan_out_env, from_path))
+        sys.exit(1)
+    print("Promoting {} into {}".format(
+        os.path.basename(from_path), ', '.join(os.path.basename(p) for p in to_paths)))
+
+    # fingerprints of the source are shared by every target even without the disk cache
+    fingerprints = open_fingerprint_cache(args) or FingerprintCache(rebuild=True)
+    from_snapshot = take_snapshot(args, from_path)
+    promotions = analyze_pairs(args, [(from_snapshot, to_path) for to_path in to_paths], fingerprints)
+    if not args.no_cache:
+        fingerprints.save()
+    review_and_promote(args, promotions, base_path, fingerprints, version)
+
+
+def main():
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
+    print('TFPromote version {}'.format(__version__))
 
     parser = create_parser()
     args = parser.parse_args()
+    start_timings(args)
     
     if args.auto_paths:
         print('WARNING: --auto argument is deprecated, this is now default behavior, omit this argument in the future.')
@@ -103,11 +617,69 @@ def main():
         parser.print_help()
         parser.exit()
 
+    try:
+        diff_engines.set_default_engine(args.diff_engine or
+                                        os.environ.get('TFPROMOTE_DIFF_ENGINE') or
+                                        diff_engines.DEFAULT_DIFF_ENGINE)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    if args.daemon:
+        from . import daemon
+        try:
+            daemon.serve(main)
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+        return
+
     if args.difftool:
         difftool = args.difftool
     else:
         difftool = os.environ.get('TFPROMOTE_DIFFTOOL', None)
 
+    # before any mode is run, so an option that mode would ignore isn't silently dropped
+    conflicting_modes = get_conflicting_modes(args)
+    if conflicting_modes:
+        print('{} can\'t be used with {}.'.format(*conflicting_modes))
+        sys.exit(1)
+
+    if args.from_rev and (args.batch_root or args.chain or args.fan_out_env or args.status
+                          or args.watch or args.plan_path or args.apply_path):
+        print('--rev can only be used to promote a single directory, without --plan or --watch.')
+        sys.exit(1)
+
+    if args.from_path and archive.is_archive(args.from_path) and \
+            (args.from_rev or args.batch_root or args.chain or args.fan_out_env or args.status
+             or args.watch or args.plan_path or args.apply_path):
+        print('An archive can only be promoted from directly into a single directory, without --rev, --plan or --watch.')
+        sys.exit(1)
+
+    if args.status:
+        run_status(args)
+        return
+
+    if args.apply_path:
+        run_apply(args)
+        return
+
+    if args.batch_root:
+        run_batch(args, difftool, __version__)
+        return
+
+    if args.watch and (args.recursive or args.include or args.exclude):
+        print('--watch only follows the .tf files directly in the environment directories, without --recursive, --include or --exclude.')
+        sys.exit(1)
+
+    if args.chain:
+        run_chain(args, difftool)
+        return
+
+    if args.fan_out_env:
+        run_fan_out(args, difftool, __version__)
+        return
+
     try:
         tf_envs = get_to_from_environments(args)
     except Exception as e:
@@ -118,41 +690,66 @@ def main():
         print("Automatically detected from and to paths.")
 
     print("From env {:<5}, path: {}".format(tf_envs['from_env'], tf_envs['from_path']))
+    if args.from_rev:
+        print("From git revision: {}".format(args.from_rev))
     print("To   env {:<5}, path: {}".format(tf_envs['to_env'], tf_envs['to_path']))
 
     # if any portion of the to or from path was unspecified (and left to auto), seek
     # confirmation before proceeding, unless --auto-approve was specified.
     if (not args.to_path or not args.from_path) and not args.auto_approve:
         print("Continue (Y/n)?")
-        response = sys.stdin.readline()
+        response = read_response()
         if response[0] == 'n':
             sys.exit(1)
 
     if difftool:
-        if not promote_tool.find_executable(difftool):
+        try:
+            executable = get_difftool_executable(difftool)
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+        if not promote_tool.find_executable(executable or ''):
             print("Could not find an executable for {}".format(difftool))
             sys.exit(1)
 
-    from_filenames = \
-        promote_tool.get_nonenv_tf_files_in_directory(tf_envs['from_path'])
-    to_filenames = \
-        promote_tool.get_nonenv_tf_files_in_directory(tf_envs['to_path'])
+    if args.watch:
+        from . import watch
+        watch.watch(tf_envs['from_path'], tf_envs['to_path'],
+                    fingerprints=open_fingerprint_cache(args), diff_mode=args.diff_mode)
+        return
 
-    from_env_filenames = \
-        promote_tool.get_env_tf_files_in_directory(tf_envs['from_path'])
-    to_env_filenames = \
-        promote_tool.get_env_tf_files_in_directory(tf_envs['to_path'])
+    try:
+        if args.from_rev:
+            from_side = git_index.GitRevisionSnapshot(
+                tf_envs['from_path'], args.from_rev, **snapshot_options(args))
+        elif archive.is_archive(tf_envs['from_path']):
+            from_side = archive.ArchiveSnapshot(tf_envs['from_path'], **snapshot_options(args))
+        else:
+            from_side = take_snapshot(args, tf_envs['from_path'])
+        to_side = take_snapshot(args, tf_envs['to_path'])
+        # archive members have no blob ids, they are compared by their sha256
+        if (args.git or args.from_rev) and not isinstance(from_side, archive.ArchiveSnapshot):
+            from_side = git_index.load_blob_ids(from_side)
+            to_side = git_index.load_blob_ids(to_side)
+    except (git_index.GitError, archive.ArchiveError) as e:
+        print(e)
+        sys.exit(1)
 
-    from_has_to_doesnt, to_has_from_doesnt = \
-        promote_tool.validate_filenames(from_filenames, to_filenames)
-    from_env_has_to_env_doesnt, to_env_has_from_env_doesnt = \
-        promote_tool.validate_filenames(from_env_filenames, to_env_filenames)
+    fingerprints = open_fingerprint_cache(args)
+    with timings.span('analyze'):
+        promotion = promote_tool.analyze_promotion(
+            from_side, to_side, ignore_missing=args.ignore_missing,
+            fingerprints=fingerprints, diff_mode=args.diff_mode, jobs=args.jobs or 1)
 
-    # add environment prefixes to the lists
-    from_env_has_to_env_doesnt = \
-        ["{}-{}".format(tf_envs['from_env'], filename) for filename in from_env_has_to_env_doesnt]
-    to_env_has_from_env_doesnt = \
-        ["{}-{}".format(tf_envs['to_env'], filename) for filename in to_env_has_from_env_doesnt]
+    if args.plan_path:
+        run_plan(args, [promote_tool.count_promotion_diffs(promotion)], fingerprints,
+                 __version__)
+        return
+
+    from_has_to_doesnt = promotion['new_files']
+    to_has_from_doesnt = promotion['missing_files']
+    from_env_has_to_env_doesnt = promotion['new_env_files']
+    to_env_has_from_env_doesnt = promotion['missing_env_files']
 
     if to_has_from_doesnt:
         print("Files present in {} not found in {}: {}".format(
@@ -180,11 +777,13 @@ def main():
             proceed = True
         else:
             print("Promote new files (N/y)?")
-            response = sys.stdin.readline()
+            response = read_response()
             if response[0] == 'y':
                 proceed = True
         if proceed:
-            promote_tool.promote_files(from_has_to_doesnt, tf_envs['from_path'], tf_envs['to_path'])
+            with timings.span('promote new files'):
+                promote_tool.promote_files(
+                    from_has_to_doesnt, promotion['from_snapshot'], tf_envs['to_path'])
         else:
             sys.exit(1)
 
@@ -197,90 +796,101 @@ def main():
             print('Resolve diffs before tfpromote will proceed.')
             sys.exit(1)
 
-    # for clarity, these should be identical at this point
-    filenames = from_filenames
-    env_filenames = from_env_filenames
-
     print('Comparing environment specific files...')
 
-    # just for comparing, these are expected to be different per environment
-    env_diffs = promote_tool.compare_filecontents(
-        env_filenames,
-        tf_envs['from_path'],
-        tf_envs['to_path'],
-        use_env_prefix=True,
-        ignore_missing=args.ignore_missing)
-
-    for filename, difflines in env_diffs:
-        from_filename = os.path.join(
-            tf_envs['from_path'], promote_tool.envprefix_from_directory(tf_envs['from_path']) + filename)
-        to_filename = os.path.join(
-            tf_envs['to_path'], promote_tool.envprefix_from_directory(tf_envs['to_path']) + filename)
-        print("Diff: \n{}\n{} - {} lines different".format(
-            from_filename, to_filename, len(difflines)))
-        if args.printdiff:
-            for line in difflines:
-                print(line)
-        elif difftool:
-            cmd = "{} {} {}".format(
-                difftool,
-                from_filename,
-                to_filename)
-            os.system(cmd)
+    from_snapshot = promotion['from_snapshot']
+    to_snapshot = promotion['to_snapshot']
 
-    print('\nComparing non-environment specific files...')
+    # (name in the review trees, from file, to file) for --dir-diff
+    review_files = []
 
-    diffs = promote_tool.compare_filecontents(
-        filenames,
-        tf_envs['from_path'],
-        tf_envs['to_path'],
-        use_env_prefix=False,
-        ignore_missing=args.ignore_missing)
+    # the diffs are computed lazily as they are printed, one file at a time
+    with timings.span('review env files'):
+        for filename, difflines in promotion['env_diffs']:
+            from_filename = from_snapshot.path(add_prefix(from_snapshot.env_prefix, filename))
+            to_filename = to_snapshot.path(add_prefix(to_snapshot.env_prefix, filename))
+            if args.printdiff:
+                print("Diff: \n{}\n{}".format(from_filename, to_filename))
+                line_count = 0
+                for line in difflines:
+                    print(line)
+                    line_count += 1
+                print("{} lines different".format(line_count))
+                continue
+            print("Diff: \n{}\n{} - {} lines different".format(
+                from_filename, to_filename, promote_tool.count_difflines(difflines)))
+            if difftool and args.dir_diff:
+                # env files have different names in each environment, so drop the prefixes
+                review_files.append(
+                    (os.path.join('env-files', filename), from_filename, to_filename))
+            elif difftool:
+                run_difftool(difftool, from_filename, to_filename)
 
-    if not diffs:
-        print('No non-environment specific differences, nothing to promote!')
-        sys.exit(0)
-    else:
-        for filename, difflines in diffs:
+    print('\nComparing non-environment specific files...')
+
+    diffs = []
+    with timings.span('review files'):
+        for filename, difflines in promotion['diffs']:
+            diffs.append(filename)
             if args.printdiff:
                 for line in difflines:
                     print(line)
             else:
                 print("Diff: {} - {} lines different".format(
-                    filename, len(difflines)))
-                if difftool:
-                    full_from_filename = os.path.join(tf_envs['from_path'], filename)
-                    full_to_filename = os.path.join(tf_envs['to_path'], filename)
-                    if not os.path.isfile(full_from_filename):
+                    filename, promote_tool.count_difflines(difflines)))
+                if difftool and args.dir_diff:
+                    review_files.append(
+                        (filename, from_snapshot.path(filename), to_snapshot.path(filename)))
+                elif difftool:
+                    full_from_filename = from_snapshot.path(filename)
+                    full_to_filename = to_snapshot.path(filename)
+                    if not from_snapshot.has(filename):
                         print("From filename does not exist: " + full_from_filename)
-                    if not os.path.isfile(full_to_filename):
+                    if not to_snapshot.has(filename):
                         print("To filename does not exist: " + full_to_filename)
-                    cmd = "{} {} {}".format(
-                        difftool,
-                        full_from_filename,
-                        full_to_filename)
-                    return_code = os.system(cmd)
+                    cmd, return_code = run_difftool(
+                        difftool, full_from_filename, full_to_filename)
                     if return_code != 0:
                         print("Error executing diff command: {}".format(cmd))
                         print("Continue (N/y)?")
-                        response = sys.stdin.readline()
+                        response = read_response()
                         if response[0] != 'y':
                             sys.exit(1)
                 else:
                     print('WARNING: No difftool specified for {}. Provide environment variable TFPROMOTE_DIFFTOOL or argument --difftool or --printdiff.'.format(filename))
 
+    if review_files:
+        print("\nReviewing {} files with {}...".format(len(review_files), difftool))
+        cmd, return_code = run_dir_diff(
+            difftool, review_files,
+            'from-{}'.format(os.path.basename(os.path.normpath(tf_envs['from_path']))),
+            'to-{}'.format(os.path.basename(os.path.normpath(tf_envs['to_path']))))
+        if return_code != 0:
+            print("Error executing diff command: {}".format(cmd))
+            print("Continue (N/y)?")
+            response = read_response()
+            if response[0] != 'y':
+                sys.exit(1)
+
+    if fingerprints:
+        fingerprints.save()
+    print_compare_stats(promotion['compare_stats'])
+
+    if not diffs:
+        print('No non-environment specific differences, nothing to promote!')
+        sys.exit(0)
 
     proceed = False
     if args.auto_approve:
         proceed = True
     else:
         print("Promote modified files (N/y)?")
-        response = sys.stdin.readline()
+        response = read_response()
         if response[0] == 'y':
             proceed = True
     if proceed:
-        for filename, _ in diffs:
-            promote_tool.promote_files([filename], tf_envs['from_path'], tf_envs['to_path'])
+        with timings.span('promote modified files'):
+            promote_tool.promote_files(diffs, promotion['from_snapshot'], tf_envs['to_path'])
     else:
         sys.exit(1)
 
@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+import collections
+
+logger = logging.getLogger(__name__)
+
+# set by enable(), while None every span is a no-op
+_recorder = None
+
+
+class Recorder(object):
+    '''Collects timed spans as Chrome trace events (chrome://tracing or
+    https://ui.perfetto.dev can open the trace file), optionally while running cProfile.'''
+
+    def __init__(self, trace_path=None, profile_path=None):
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+        self.events = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.profiler = None
+        if profile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def add(self, name, category, started, elapsed, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((started - self.started) * 1e6),
+            'dur': int(elapsed * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def phase_summary(self):
+        '''Returns [(name, count, seconds, bytes)] sorted by total time, longest first.
+        Spans nest, so a phase's time includes the phases inside it.'''
+        totals = collections.OrderedDict()
+        for event in self.events:
+            count, elapsed, size = totals.get(event['name'], (0, 0, 0))
+            totals[event['name']] = (count + 1, elapsed + event['dur'] / 1e6,
+                                     size + event['args'].get('bytes', 0))
+        return sorted([(name,) + total for name, total in totals.items()],
+                      key=lambda total: -total[2])
+
+    def print_summary(self):
+        print("\nTimings ({:.3f} seconds total):".format(time.time() - self.started))
+        for name, count, elapsed, size in self.phase_summary():
+            line = "    {:<28} {:>6} x {:>10.4f}s".format(name, count, elapsed)
+            if size:
+                line += "  {:>12} bytes".format(size)
+            print(line)
+
+    def finish(self):
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            print("cProfile stats written to {}".format(self.profile_path))
+        self.print_summary()
+        if self.trace_path:
+            with open(self.trace_path, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+            print("Trace written to {}".format(self.trace_path))
+        sys.stdout.flush()
+
+
+class Span(object):
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        recorder = _recorder
+        if recorder is not None:
+            recorder.add(self.name, self.category, self.started,
+                         time.time() - self.started, self.args)
+        return False
+
+    def set(self, **args):
+        '''Adds arguments only known once the span is done, e.g. bytes copied.'''
+        self.args.update(args)
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def enable(trace_path=None, profile_path=None):
+    global _recorder
+    _recorder = Recorder(trace_path, profile_path)
+    return _recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def finish():
+    '''Stops recording, prints the phase summary and writes the trace and profile.'''
+    global _recorder
+    recorder = _recorder
+    _recorder = None
+    if recorder is not None:
+        recorder.finish()
+
+
+def span(name, category='phase', **args):
+    '''Times the with block it is used in, e.g.
+
+        with timings.span('promote', files=len(filenames)) as s:
+            ...
+            s.set(bytes=bytes_copied)
+    '''
+    if _recorder is None:
+        return NULL_SPAN
+    return Span(name, category, args)
+
+
+def traced(name=None):
+    '''Decorator timing every call of a function in a span named after it.'''
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with Span(span_name, 'function', {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
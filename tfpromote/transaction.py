@@ -0,0 +1,211 @@
+import os
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+from . import timings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# from linux/fs.h, clones a file's extents on filesystems that support reflinks
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def clone_file(src, dst):
+    '''Reflinks src into dst, returns False if the filesystem can't.'''
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def copy_file_range(src, dst, size):
+    '''Copies with os.copy_file_range so the data stays in the kernel, returns False if
+    it isn't available for these files.'''
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            if count == 0:
+                break
+            copied += count
+        return True
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                           errno.EBADF):
+            raise
+        # start over with a plain copy
+        src.seek(0)
+        dst.seek(0)
+        dst.truncate()
+        return False
+
+
+def copy_and_hash(src, dst, digest):
+    '''Copies a chunk at a time, adding each chunk to the hashlib digest.  Returns the
+    number of bytes copied.'''
+    size = 0
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return size
+        digest.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+
+
+def copy_file(src_path, dst_path, digest=None):
+    '''Copies src_path to dst_path and fsyncs it, returning the number of bytes copied.
+    Reflinks or os.copy_file_range are used where the platform supports them so the
+    data doesn't need to pass through userspace.  If a hashlib digest is given the data
+    is read instead and the digest updated with exactly the bytes written.'''
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if digest is not None:
+            size = copy_and_hash(src, dst, digest)
+        else:
+            size = os.fstat(src.fileno()).st_size
+            if not clone_file(src, dst) and not copy_file_range(src, dst, size):
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return size
+
+
+def fsync_directory(directory):
+    '''Makes renames in directory durable, where the platform allows opening directories.'''
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PromotionTransaction(object):
+    '''Promotes a set of files all or nothing.  Each file is first staged (copied) into a
+    temporary directory inside its target directory, so on the same filesystem, and only
+    once every file is staged are they renamed over their targets.  If a rename fails the
+    targets already replaced are restored from hard links to their previous contents.
+    Target directories which don't exist yet, e.g. a new module's, are staged in their
+    nearest existing parent and created on commit.  Use as a context manager so staged files are cleaned up if an error occurs before
+    commit.'''
+
+    def __init__(self):
+        self.staging_dirs = {}
+        # (staged path, target path)
+        self.staged = []
+        self.bytes_copied = 0
+        self.started = time.time()
+        self.elapsed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    def staging_dir_for(self, target_path):
+        target_dir = os.path.dirname(target_path)
+        while not os.path.isdir(target_dir):
+            target_dir = os.path.dirname(target_dir)
+        if target_dir not in self.staging_dirs:
+            self.staging_dirs[target_dir] = tempfile.mkdtemp(
+                prefix='.tfpromote-staging-', dir=target_dir)
+        return self.staging_dirs[target_dir]
+
+    def stage(self, source_path, target_path, sha256=None):
+        '''Copies source_path into the staging directory to replace target_path on
+        commit.  If the sha256 source_path is expected to have is given, the bytes are
+        hashed as they are copied and staging fails if they don't match, so a file
+        which changed since it was checked is never promoted.'''
+        staged_path = os.path.join(
+            self.staging_dir_for(target_path),
+            "{}-{}".format(len(self.staged), os.path.basename(target_path)))
+        digest = hashlib.sha256() if sha256 else None
+        with timings.span('copy file', 'file', file=target_path) as span:
+            copied = copy_file(source_path, staged_path, digest)
+            span.set(bytes=copied)
+        if digest is not None and digest.hexdigest() != sha256:
+            os.remove(staged_path)
+            raise Exception("{} changed, its sha256 is {} instead of {}".format(
+                source_path, digest.hexdigest(), sha256))
+        self.bytes_copied += copied
+        if os.path.exists(target_path):
+            # a replaced file keeps its permissions, as it did when copied over in place
+            shutil.copymode(target_path, staged_path)
+        self.staged.append((staged_path, target_path))
+
+    def backup(self, target_path, staged_path):
+        backup_path = staged_path + '.orig'
+        try:
+            os.link(target_path, backup_path)
+        except (OSError, AttributeError):
+            shutil.copy2(target_path, backup_path)
+        return backup_path
+
+    def make_target_dir(self, target_dir, created_dirs):
+        '''Creates target_dir and any missing parents, adding them to created_dirs.'''
+        missing = []
+        while not os.path.isdir(target_dir):
+            missing.append(target_dir)
+            target_dir = os.path.dirname(target_dir)
+        for directory in reversed(missing):
+            os.mkdir(directory)
+            created_dirs.append(directory)
+
+    @timings.traced('commit')
+    def commit(self):
+        committed = []
+        created_dirs = []
+        try:
+            for staged_path, target_path in self.staged:
+                self.make_target_dir(os.path.dirname(target_path), created_dirs)
+                backup_path = None
+                if os.path.exists(target_path):
+                    backup_path = self.backup(target_path, staged_path)
+                os.replace(staged_path, target_path)
+                committed.append((target_path, backup_path))
+        except Exception:
+            logger.error("Promotion failed, restoring {} files already promoted".format(
+                len(committed)))
+            for target_path, backup_path in reversed(committed):
+                if backup_path:
+                    os.replace(backup_path, target_path)
+                else:
+                    os.remove(target_path)
+            for directory in reversed(created_dirs):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+            raise
+        finally:
+            target_dirs = set(os.path.dirname(target_path) for _, target_path in self.staged)
+            for target_dir in target_dirs | set(self.staging_dirs):
+                if os.path.isdir(target_dir):
+                    fsync_directory(target_dir)
+        self.elapsed = time.time() - self.started
+
+    def cleanup(self):
+        for staging_dir in self.staging_dirs.values():
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.staging_dirs = {}
+
+    def summary(self):
+        return "Promoted {} files, {} bytes in {:.3f} seconds".format(
+            len(self.staged), self.bytes_copied, self.elapsed or 0)
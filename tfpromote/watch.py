@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+from .snapshot import DirectorySnapshot
+from . import promote_tool
+
+logger = logging.getLogger(__name__)
+
+# from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+# how long to wait for more changes before updating, editors often write several times
+DEBOUNCE_SECONDS = 0.3
+POLL_INTERVAL_SECONDS = 1.0
+
+
+class InotifyWatcher(object):
+    '''Reports the names of files changed in a set of directories using Linux inotify.'''
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()),
+                                        WATCH_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(directory))
+
+    def wait(self, timeout=None):
+        '''Blocks up to timeout seconds (forever if None) for changes.  Returns the set of
+        changed filenames, empty if nothing changed, or None if events were lost and
+        everything should be checked again.'''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                _, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + name_length].rstrip(b'\0')
+                offset += name_length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if name:
+                    changed.add(name.decode(sys.getfilesystemencoding(), 'replace'))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    '''Reports the names of files changed in a set of directories by polling their
+    mtimes and sizes, for platforms without inotify.'''
+
+    def __init__(self, directories, interval=POLL_INTERVAL_SECONDS):
+        self.directories = directories
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        for directory in self.directories:
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    stat_result = entry.stat()
+                    state[(directory, entry.name)] = (stat_result.st_mtime_ns, stat_result.st_size)
+        return state
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = self.interval if deadline is None else \
+                min(self.interval, deadline - time.time())
+            if remaining > 0:
+                time.sleep(remaining)
+            state = self.scan()
+            changed = set(key[1] for key in set(state) | set(self.state)
+                          if state.get(key) != self.state.get(key))
+            self.state = state
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(directories):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as e:
+            logger.info("inotify unavailable, polling for changes instead: {}".format(e))
+    return PollingWatcher(directories)
+
+
+class PendingPromotion(object):
+    '''What promoting from_path into to_path would do, kept up to date one file at a
+    time as files change.  nonenv and env map filenames (env files without their prefix)
+    to ('new' | 'missing' | 'modified', lines different).'''
+
+    def __init__(self, from_path, to_path, fingerprints=None, diff_mode='line'):
+        self.from_path = from_path
+        self.to_path = to_path
+        self.fingerprints = fingerprints
+        self.diff_mode = diff_mode
+        self.nonenv = {}
+        self.env = {}
+        self.refresh()
+
+    def file_status(self, filename, from_snapshot, to_snapshot, use_env_prefix):
+        from_prefix = from_snapshot.env_prefix if use_env_prefix else ''
+        to_prefix = to_snapshot.env_prefix if use_env_prefix else ''
+        in_from = from_snapshot.has(from_prefix + filename)
+        in_to = to_snapshot.has(to_prefix + filename)
+        if in_from and not in_to:
+            return ('new', 0)
+        if in_to and not in_from:
+            return ('missing', 0)
+        if not in_from and not in_to:
+            return None
+        line_count = sum(promote_tool.count_difflines(difflines) for _, difflines in
+                         promote_tool.iter_filecontents_diffs(
+                             [filename], from_snapshot, to_snapshot, use_env_prefix,
+                             ignore_missing=True, fingerprints=self.fingerprints,
+                             diff_mode=self.diff_mode))
+        if line_count:
+            return ('modified', line_count)
+        return None
+
+    def refresh(self, changed=None):
+        '''Rescans both directories and compares the changed filenames again, or every
+        file if changed is None.'''
+        from_snapshot = DirectorySnapshot(self.from_path)
+        to_snapshot = DirectorySnapshot(self.to_path)
+        if changed is None:
+            self.nonenv = {}
+            self.env = {}
+            nonenv_names = from_snapshot.nonenv_set | to_snapshot.nonenv_set
+            env_names = from_snapshot.env_set | to_snapshot.env_set
+        else:
+            nonenv_names = set()
+            env_names = set()
+            for name in changed:
+                if not name.endswith('.tf'):
+                    continue
+                for prefix in (from_snapshot.env_prefix, to_snapshot.env_prefix):
+                    if name.startswith(prefix):
+                        env_names.add(name[len(prefix):])
+                        break
+                else:
+                    nonenv_names.add(name)
+        for names, results, use_env_prefix in [(nonenv_names, self.nonenv, False),
+                                               (env_names, self.env, True)]:
+            for filename in names:
+                status = self.file_status(filename, from_snapshot, to_snapshot, use_env_prefix)
+                if status:
+                    results[filename] = status
+                else:
+                    results.pop(filename, None)
+
+    def print_summary(self):
+        counts = dict((kind, sum(1 for status, _ in self.nonenv.values() if status == kind))
+                      for kind in ('new', 'modified', 'missing'))
+        print("[{}] {} -> {}: {} new, {} modified, {} missing".format(
+            time.strftime('%H:%M:%S'), self.from_path, self.to_path,
+            counts['new'], counts['modified'], counts['missing']))
+        for filename in sorted(self.nonenv):
+            status, line_count = self.nonenv[filename]
+            if status == 'modified':
+                print("    {:<9} {} - {} lines different".format(status, filename, line_count))
+            else:
+                print("    {:<9} {}".format(status, filename))
+        for filename in sorted(self.env):
+            status, line_count = self.env[filename]
+            print("    {:<9} env file {} ({} lines different)".format(status, filename, line_count))
+        sys.stdout.flush()
+
+
+def watch(from_path, to_path, fingerprints=None, diff_mode='line'):
+    '''Prints what would be promoted, then again each time files change until
+    interrupted.  Only the files that changed are compared again.'''
+    pending = PendingPromotion(from_path, to_path, fingerprints, diff_mode)
+    pending.print_summary()
+    watcher = create_watcher([from_path, to_path])
+    print("Watching for changes ({}), press CTRL+C to stop.".format(
+        'inotify' if isinstance(watcher, InotifyWatcher) else 'polling'))
+    try:
+        while True:
+            changed = watcher.wait()
+            # collect changes until things settle down
+            while changed is not None:
+                more = watcher.wait(DEBOUNCE_SECONDS)
+                if not more:
+                    if more is None:
+                        changed = None
+                    break
+                changed |= more
+            if changed is not None and not any(name.endswith('.tf') for name in changed):
+                continue
+            pending.refresh(changed)
+            pending.print_summary()
+            if fingerprints:
+                fingerprints.save()
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    finally:
+        watcher.close()